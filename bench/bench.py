@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for the spacex and twittertwython plugins.
+
+Replays the recorded Space Launch Now, SpaceX v4 and Twitter stream responses
+in bench/fixtures through the parsers and commands, using a fake bot and a
+requests adapter that stands in for the upstream APIs. Needs the plugins'
+own dependencies (sopel, requests, pendulum, twython) installed.
+
+    python bench/bench.py [-n ITERATIONS] [-k FILTER]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import spacex  # noqa: E402
+import twittertwython  # noqa: E402
+
+
+def load(name):
+    with open(os.path.join(HERE, 'fixtures', name), encoding='utf-8') as fh:
+        if name.endswith('.jsonl'):
+            return [json.loads(line) for line in fh if line.strip()]
+        return json.load(fh)
+
+
+class FixtureAdapter(BaseAdapter):
+    """Answers the plugins' HTTP requests from the fixtures and counts them."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.sln = load('sln_upcoming.json')
+        v4 = load('spacex_v4.json')
+        self.launches = v4['launches']
+        self.entities = v4['entities']
+
+    def populate(self, launch, paths):
+        launch = json.loads(json.dumps(launch))
+        for path in paths:
+            field, _, sub = path.partition('.')
+            kind = {'rocket': 'rockets', 'launchpad': 'launchpads', 'payloads': 'payloads'}.get(field)
+            if sub:
+                kind = {'core': 'cores', 'landpad': 'landpads'}[sub]
+                for item in launch[field]:
+                    item[sub] = self.entities[kind].get(item[sub], item[sub])
+            elif isinstance(launch[field], list):
+                launch[field] = [self.entities[kind].get(id, id) for id in launch[field]]
+            else:
+                launch[field] = self.entities[kind].get(launch[field], launch[field])
+        return launch
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        url = urllib.parse.urlsplit(request.url)
+        parts = url.path.strip('/').split('/')
+        if url.hostname == 'spacelaunchnow.me':
+            if parts[-1] == 'upcoming':
+                body = self.sln
+            else:
+                body = next(r for r in self.sln['results'] if str(r['id']) == parts[-1])
+        elif parts[-1] == 'query':
+            options = json.loads(request.body)['options']
+            launches = self.launches[:options.get('limit', len(self.launches))]
+            body = {'docs': [self.populate(launch, options.get('populate', [])) for launch in launches]}
+        else:
+            kind, id = parts[-2:]
+            body = self.entities[kind][id]
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response._content = json.dumps(body).encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def get_nick_value(self, nick, key, default=None):
+        return default
+
+    def get_channel_value(self, channel, key, default=None):
+        return default
+
+    def get_plugin_value(self, plugin, key, default=None):
+        return default
+
+
+class FakeBot:
+    def __init__(self):
+        self.lines = 0
+        self.db = FakeDB()
+
+    def say(self, message, destination=None, max_messages=1):
+        self.lines += 1
+
+    def reply(self, message):
+        self.lines += 1
+
+
+class FakeTrigger:
+    def __init__(self, args=None, nick='bencher', sender='#bench'):
+        self.args = args
+        self.nick = nick
+        self.sender = sender
+
+    def group(self, n):
+        return self.args if n == 2 else None
+
+
+def measure(name, fn, iterations, adapter, reset=None):
+    timings = []
+    calls = adapter.calls
+    for i in range(iterations):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - start)
+    calls = (adapter.calls - calls) / iterations
+
+    # a separate pass so tracemalloc overhead stays out of the timings
+    if reset:
+        reset()
+    tracemalloc.start()
+    fn(0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<34} {statistics.mean(timings) * 1e6:>11.1f} {p95 * 1e6:>11.1f} {calls:>10.2f} {peak / 1024:>10.1f}")
+
+
+def bench_spacex(iterations, adapter, selected):
+    sln = load('sln_upcoming.json')
+    v4 = load('spacex_v4.json')
+    raw = v4['launches']
+    populated = [adapter.populate(launch, ['rocket', 'launchpad', 'payloads', 'cores.core', 'cores.landpad']) for launch in raw]
+    descriptions = [result['mission']['description'] for result in sln['results']]
+    bot = FakeBot()
+    sln_provider = spacex.PROVIDERS['sln']
+    spacex_provider = spacex.PROVIDERS['spacex']
+
+    def render(provider, launch):
+        return spacex._launch_lines(provider.normalize(launch))
+
+    def fresh_resolver():
+        spacex.RESOLVER.attach(None)
+        spacex.RESOLVER = spacex.EntityResolver()
+
+    # what a restart finds on disk
+    store = os.path.join(tempfile.mkdtemp(), 'spacex-entities.db')
+    fresh_resolver()
+    spacex.RESOLVER.attach(spacex.EntityStore(store))
+    spacex.RESOLVER.resolve(raw)
+
+    def restarted_resolver():
+        fresh_resolver()
+        spacex.RESOLVER.attach(spacex.EntityStore(store))
+
+    def fresh_poller():
+        spacex.POLLER = spacex.LaunchPoller()
+
+    benchmarks = [
+        ('is_tbd', lambda i: spacex.is_tbd(raw[i % len(raw)]['date_utc']), None),
+        ('_normalizeWhitespace', lambda i: spacex._normalizeWhitespace(descriptions[i % len(descriptions)]), None),
+        ('render sln', lambda i: render(sln_provider, sln['results'][i % len(sln['results'])]), None),
+        ('render spacex (cold ids)', lambda i: render(spacex_provider, raw[i % len(raw)]), fresh_resolver),
+        ('render spacex (restart)', lambda i: render(spacex_provider, raw[i % len(raw)]), restarted_resolver),
+        ('render spacex (populated)', lambda i: render(spacex_provider, populated[i % len(populated)]), None),
+        ('!launch (cold)', lambda i: spacex.launch(bot, FakeTrigger(str(i % 5 + 1))), fresh_poller),
+        ('!launch (warm)', lambda i: spacex.launch(bot, FakeTrigger(str(i % 5 + 1))), None),
+        ('!spacex (cold)', lambda i: spacex.spacex(bot, FakeTrigger(str(i % 11))), fresh_poller),
+        ('!spacex (warm)', lambda i: spacex.spacex(bot, FakeTrigger(str(i % 11))), None),
+    ]
+    fresh_poller()
+    for name, fn, reset in benchmarks:
+        if selected in name:
+            measure(name, fn, iterations, adapter, reset)
+
+
+def bench_twitter(iterations, adapter, selected):
+    tweets = load('twitter_stream.jsonl')
+    bot = FakeBot()
+    twittertwython.ROUTES = twittertwython.RoutingTable('#bench')
+    twittertwython.QUEUE = twittertwython.OutboundQueue(bot, size=len(tweets) * iterations + 1)
+    stream = twittertwython._streamer_class()('key', 'secret', 'token', 'secret')
+
+    def fresh_dedup():
+        twittertwython.DEDUP = twittertwython.TweetDeduper()
+
+    name = 'MyStreamer.on_success'
+    if selected in name:
+        # a fresh index per call, or every replayed tweet after the first pass is a repeat
+        measure(name, lambda i: stream.on_success(tweets[i % len(tweets)]), iterations, adapter, fresh_dedup)
+        measure(name + ' (repeats)', lambda i: stream.on_success(tweets[i % len(tweets)]), iterations, adapter)
+
+        elapsed = 0
+        for _ in range(iterations):
+            fresh_dedup()
+            start = time.perf_counter()
+            for tweet in tweets:
+                stream.on_success(tweet)
+            elapsed += time.perf_counter() - start
+        print(f"{'  throughput':<34} {len(tweets) * iterations / elapsed:>11.0f} tweets/sec, "
+              f"{twittertwython.QUEUE.depth} queued")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    spacex.LOGGER = twittertwython.LOGGER = logging.getLogger('bench')
+    adapter = FixtureAdapter()
+    spacex.HTTP.session.mount('https://', adapter)
+    # measure the code, not the request budget
+    spacex.HTTP._limiters.clear()
+    # pay for the lazy imports before anything is timed
+    spacex._now()
+
+    print(f"{'benchmark':<34} {'mean us':>11} {'p95 us':>11} {'http/call':>10} {'peak KiB':>10}")
+    bench_spacex(args.iterations, adapter, args.filter)
+    bench_twitter(args.iterations, adapter, args.filter)
+
+
+if __name__ == '__main__':
+    main()
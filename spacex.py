@@ -9,139 +9,608 @@ from sopel.tools.time import (
     validate_timezone
 )
 
-import requests
-import urllib.parse
-import pendulum
-
+from sqlalchemy.exc import SQLAlchemyError
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from dataclasses import dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+import contextlib
+import functools
+import heapq
+import json
+import os
 import re
+import sqlite3
+import threading
+import time
+import urllib.parse
 
 LOGGER = None
 
+# only ASCII whitespace, as the Limnoria original; \s would also eat NBSPs and the like
+WHITESPACE_RE = re.compile(r'[ \t\r\n]+')
+BLANKS_RE = re.compile(r'[ \t]+')
+
+LAUNCH_TIME_FORMAT = 'MMM Do @ h:mm A zz'
+LOCAL_TIME_FORMAT = 'MMM Do, h:mmA'
+SPACEX_UTC_FORMAT = 'MMM Do, H:mm zz'
+
+# timezones people have asked for, pre-rendered whenever the launches change
+SEEN_ZONES = set()
+
+# stands in for the relative time in cached replies, filled in on every use
+CLOCK_MARK = '\x00clock\x00'
+
+# seconds to keep each kind of SpaceX entity before fetching it again
+ENTITY_TTL = {
+    'launchpads': 24 * 3600,
+    'rockets': 24 * 3600,
+    'landpads': 24 * 3600,
+    'cores': 3600,
+    'payloads': 3600,
+}
+# after a failed revalidation, keep serving the stored copy this long before trying again
+ENTITY_RETRY = 300
+ENTITY_URL = "https://api.spacexdata.com/v4/{kind}/{id}"
+
+SLN_UPCOMING_URL = "https://spacelaunchnow.me/api/3.3.0/launch/upcoming/?format=json&limit=5"
+SPACEX_QUERY_URL = "https://api.spacexdata.com/v4/launches/query"
+# !spacex accepts indexes 0-10, so one snapshot covers every command
+SPACEX_SNAPSHOT_SIZE = 11
+
+# Space Launch Now location IDs we know the timezone of, and SpaceX's agency ID
+SLN_TIMEZONES = {
+    11: "US/Pacific",
+    12: "US/Eastern",
+}
+SLN_SPACEX_AGENCY = 121
+
+# which providers answer each command, best first
+SOURCES = {
+    'launch': ('sln', 'spacex'),
+    'spacex': ('spacex', 'sln'),
+}
+# seconds a reply waits on providers that have nothing loaded yet before falling back
+PROVIDER_BUDGET = 2.5
+
+# the poller speeds up as T-0 gets closer: (seconds from T-0, poll interval)
+POLL_INTERVALS = (
+    (3600, 30),
+    (6 * 3600, 60),
+    (24 * 3600, 150),
+)
+POLL_IDLE_INTERVAL = 600
+# while a provider has never answered (no network at boot, say), retry this often
+POLL_RETRY_INTERVAL = 30
+
+# launch alerts as (seconds before T-0, how that is worded)
+ALERTS = (
+    (3600, "1 hour"),
+    (1800, "30 minutes"),
+    (600, "10 minutes"),
+    (60, "1 minute"),
+)
+# an alert that is due more than this many seconds ago is dropped, not sent late
+ALERT_GRACE = 30
+ALERT_CHANNEL = "#spacex"
+
+# at most this many manifest changes are announced per poll
+SCHEDULE_UPDATE_LIMIT = 5
+
+POLLER = None
+SCHEDULER = None
+STATE = None
+HISTORY = None
+# set once setup's background work has loaded STATE
+READY = threading.Event()
+DIFF = None
+METRICS_SERVER = None
+
+# (connect, read) timeouts in seconds, per upstream host
+HTTP_TIMEOUTS = {
+    'api.spacexdata.com': (3.05, 10),
+    'spacelaunchnow.me': (3.05, 15),
+}
+HTTP_DEFAULT_TIMEOUT = (3.05, 10)
+
+# per-host request budget as (requests, per seconds)
+RATE_LIMITS = {
+    'api.spacexdata.com': (50, 1),
+    'spacelaunchnow.me': (30, 60),
+}
+# longest a 429/503 Retry-After may pause a host's budget for
+RETRY_AFTER_CAP = 300
+
 class SpaceXSection(StaticSection):
     channel = ValidatedAttribute('channel', default=NO_DEFAULT)
+    metrics_host = ValidatedAttribute('metrics_host', default='127.0.0.1')
+    metrics_port = ValidatedAttribute('metrics_port', int, default=None)
+    metrics_file = ValidatedAttribute('metrics_file', default=None)
+    entity_cache = ValidatedAttribute('entity_cache', default=None)
+    history_db = ValidatedAttribute('history_db', default=None)
+
+class Metrics:
+    """Counters, gauges and timers for the plugin's hot paths.
+
+    Every plugin registers an object with a ``snapshot()`` of this shape in
+    ``bot.memory['metrics']``, and this plugin exports them all together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, fn, **labels):
+        self._gauges[self._key(name, labels)] = fn
+
+    def snapshot(self):
+        with self._lock:
+            counters = list(self._counters.items())
+            timers = [(key, list(timer)) for key, timer in self._timers.items()]
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': fn()} for (name, labels), fn in list(self._gauges.items())],
+            'timers': [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': peak}
+                       for (name, labels), (count, total, peak) in timers],
+        }
+
+    def total(self, name, **labels):
+        """Sums a counter over every label set that includes ``labels``."""
+        with self._lock:
+            return sum(value for (key, key_labels), value in self._counters.items()
+                       if key == name and set(labels.items()) <= set(key_labels))
+
+METRICS = Metrics()
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def render_prometheus(registry):
+    """Renders every registered plugin's metrics in the Prometheus text format."""
+    families = {}
+
+    def sample(family, kind, name, labels, value):
+        families.setdefault(family, (kind, []))[1].append(f"{name}{_prometheus_labels(labels)} {value}")
+
+    for plugin, metrics in sorted(registry.items()):
+        snapshot = metrics.snapshot()
+        for counter in snapshot['counters']:
+            name = f"{plugin}_{counter['name']}_total"
+            sample(name, 'counter', name, counter['labels'], counter['value'])
+        for gauge in snapshot['gauges']:
+            name = f"{plugin}_{gauge['name']}"
+            sample(name, 'gauge', name, gauge['labels'], gauge['value'])
+        for timer in snapshot['timers']:
+            name = f"{plugin}_{timer['name']}_seconds"
+            sample(name, 'summary', f"{name}_count", timer['labels'], timer['count'])
+            sample(name, 'summary', f"{name}_sum", timer['labels'], f"{timer['sum']:.6f}")
+            sample(f"{name}_max", 'gauge', f"{name}_max", timer['labels'], f"{timer['max']:.6f}")
+
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f"# TYPE {family} {kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus(self.server.registry).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _timed(command):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer('command', command=command):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _say(bot, message, destination=None, max_messages=1):
+    with METRICS.timer('say'):
+        bot.say(message, destination, max_messages=max_messages)
+
+def _set_plugin_values(database, plugin, values):
+    # same storage as bot.db.set_plugin_value, but all keys in one transaction
+    session = database.ssession()
+    try:
+        for key, value in values.items():
+            session.merge(db.PluginValues(plugin=plugin.lower(), key=key, value=json.dumps(value, ensure_ascii=False)))
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    finally:
+        database.ssession.remove()
+
+@dataclass
+class LaunchState:
+    """The next launch as last seen by periodic_spacex, mirrored in bot.db."""
+    nextlaunch: Optional[int] = None
+    nextlaunch_date: Optional[str] = None
+    nextlaunch_name: Optional[str] = None
+    nextlaunch_webcast: Optional[str] = None
+
+    @classmethod
+    def load(cls, database):
+        return cls(**{field.name: database.get_plugin_value("spacex", field.name) for field in fields(cls)})
+
+    def update(self, database, **values):
+        """Writes through the fields that actually changed; returns them."""
+        changed = {key: value for key, value in values.items() if getattr(self, key) != value}
+        if changed:
+            _set_plugin_values(database, "spacex", changed)
+            for key, value in changed.items():
+                setattr(self, key, value)
+        return changed
 
 def setup(bot):
     global LOGGER
     
     bot.config.define_section('spacex', SpaceXSection)
 
-    bot.db.set_plugin_value("spacex", "nextlaunch", None)
-    bot.db.set_plugin_value("spacex", "nextlaunch_date", None)
-    bot.db.set_plugin_value("spacex", "nextlaunch_name", None)
-    bot.db.set_plugin_value("spacex", "nextlaunch_webcast", None)
-
     LOGGER = tools.get_logger('spacex')
 
+    bot.memory.setdefault('metrics', {})['spacex'] = METRICS
+    if bot.config.spacex.metrics_port:
+        global METRICS_SERVER
+        METRICS_SERVER = ThreadingHTTPServer((bot.config.spacex.metrics_host, bot.config.spacex.metrics_port), MetricsHandler)
+        METRICS_SERVER.registry = bot.memory['metrics']
+        threading.Thread(target=METRICS_SERVER.serve_forever, name='spacex-metrics', daemon=True).start()
+
+    global DIFF
+    DIFF = ScheduleDiff()
+
+    global SCHEDULER
+    SCHEDULER = CountdownScheduler(bot)
+    SCHEDULER.start()
+
+    # the first poll prefetches the launches, everything else that touches
+    # the disk is done on its own thread too so loading the plugin doesn't wait
+    global POLLER
+    POLLER = LaunchPoller()
+    READY.clear()
+    threading.Thread(target=_load, args=(bot,), name='spacex-setup', daemon=True).start()
+
+def _load(bot):
+    global HISTORY
+    global STATE
+    try:
+        try:
+            RESOLVER.attach(EntityStore(bot.config.spacex.entity_cache or
+                                        os.path.join(bot.config.core.homedir, 'spacex-entities.db')))
+        except Exception:
+            LOGGER.exception("Couldn't open the entity cache")
+        try:
+            HISTORY = LaunchHistory(bot.config.spacex.history_db or
+                                    os.path.join(bot.config.core.homedir, 'spacex-history.db'))
+        except Exception:
+            LOGGER.exception("Couldn't open the launch history")
+        try:
+            STATE = LaunchState.load(bot.db)
+        except Exception:
+            LOGGER.exception("Couldn't load the launch state")
+        SCHEDULER.arm(STATE.nextlaunch_date, STATE.nextlaunch_name, STATE.nextlaunch_webcast)
+    except Exception:
+        LOGGER.exception("Couldn't arm the launch countdown")
+    finally:
+        # whatever failed above, periodic_spacex and the poller still have to run
+        if STATE is None:
+            STATE = LaunchState()
+        READY.set()
+        # after the store is attached, so the first resolve can use it
+        POLLER.start()
+
+def shutdown(bot):
+    if POLLER:
+        POLLER.stop()
+    if SCHEDULER:
+        SCHEDULER.stop()
+    RESOLVER.attach(None)
+    if HISTORY:
+        HISTORY.close()
+    if METRICS_SERVER:
+        METRICS_SERVER.shutdown()
+        METRICS_SERVER.server_close()
+
 # from Supybot/Limnoria utils.str
 def _normalizeWhitespace(s, removeNewline=True):
-    r"""Normalizes the whitespace in a string; \s+ becomes one space."""
+    """Normalizes the whitespace in a string; runs of spaces, tabs and
+    newlines become one space."""
     if not s:
         return str(s) # not the same reference
-    starts_with_space = (s[0] in ' \n\t\r')
-    ends_with_space = (s[-1] in ' \n\t\r')
     if removeNewline:
-        newline_re = re.compile('[\r\n]+')
-        s = ' '.join(filter(bool, newline_re.split(s)))
-    s = ' '.join(filter(bool, s.split('\t')))
-    s = ' '.join(filter(bool, s.split(' ')))
-    if starts_with_space:
-        s = ' ' + s
-    if ends_with_space:
-        s += ' '
+        s = WHITESPACE_RE.sub(' ', s)
+    else:
+        s = BLANKS_RE.sub(' ', s)
     if len(s) > 200:
         s = s[:199] + "…"
     return s
 
+# pendulum and requests take a while to import, so they are only imported
+# by the functions that use them, on whichever thread gets there first
+
+def _now():
+    import pendulum
+    return pendulum.now('UTC')
+
+@functools.lru_cache(maxsize=256)
+def _parse_time(ts):
+    import pendulum
+    return pendulum.parse(ts)
+
+@functools.lru_cache(maxsize=256)
+def _in_tz(ts, tz):
+    return _parse_time(ts).in_tz(tz)
+
+@functools.lru_cache(maxsize=1024)
+def _render_time(ts, tz, fmt):
+    # tz=None keeps the offset the timestamp was given in
+    if tz:
+        return _in_tz(ts, tz).format(fmt)
+    return _parse_time(ts).format(fmt)
+
 def is_tbd(ts):
-    dt = pendulum.parse(ts)
+    dt = _parse_time(ts)
     if dt.day == 1 and dt.hour == 0 and dt.minute == 0 and dt.second == 0 and dt.microsecond == 0:
         return True
     
     return False
 
-def _parse_results(data, desc=None, idx=0, tz=None):
-    # parses data from API
-
-    timezones = {
-        11: "US/Pacific",
-        12: "US/Eastern",
-    }
-
-    try:
-        tmp = data["results"][idx]
-        data = requests.get(tmp['url']).json()
-        # print(url)
-    except:
-        data = data["results"][idx]
-    name = data['name'].strip()
-    if "  " in name:
-        name = name.split()
-        name = " ".join(name)
-    location = "{} ({})".format(data['pad']['name'], data['pad']['location']['name']) 
-    loc_id = data['pad']['location']['id']
-    tz = tz or timezones.get(loc_id) or "UTC"
-    when = pendulum.parse(data['net']).in_tz(tz)
-    status = data['status']['name']
-    if "Go" in status:
-        status = color(status, "green")
-    if data['probability']:
-        prob = f" ({data['probability']}%)" if data['probability'] > 0 else ""
-    else:
-        prob = ""
-    try:
-        # {data['mission']['name']} -> 
-        mission = f"{_normalizeWhitespace(data['mission']['description'])}"
-    except:
-        mission = None
-
-    landing = None
-    rocket = None
-    if data['pad']['agency_id'] == 121:
-        # SpaceX Landing Attempt?
-        rockets = data['rocket']['launcher_stage']
-        if len(rockets) == 1:
-            # Falcon 9 Block 5
-            landing = rockets[0]['landing']['attempt']
-            # reused = rockets[0]['reused']
-            # if reused:
-            rocket = "Flight #{} for this booster.".format(rockets[0]['launcher_flight_number'])
-            if landing:
-                landing = rockets[0]['landing']['description']
-        else:
-            # Falcon Heavy
-            #TBD
-            pass
-    lines = []
-    if status != "TBD":
-        lines.append(f"\x02[Launch]\x02 {name} from {location} \x02[When]\x02 {color(when.format('MMM Do @ h:mm A zz'), 'cyan')} \x02[Status]\x02 {status}{prob}")
-    else:
-        lines.append(f"\x02[Launch]\x02 {name} from {location} \x02[When]\x02 {color(when.format('MMM Do @ h:mm A zz'), 'cyan')}")
-    if mission: lines.append("\x02[Mission]\x02 " + mission)
-    if data.get('vidURLs'):
-        vid = " \x02[Watch]\x02 {}".format(', '.join(list(set(data['vidURLs']))))
-        # vid = " \x02[Watch]\x02 {}".format(data['vidURLs'])
-    else:
-        vid = ""
+def _clock(ts, tz):
+    when = _in_tz(ts, tz)
     if when.diff(None, False).seconds < 0:
         stub = "-"
     else:
         stub = "+"
-    if not vid: lines.append(f"\x02[Clock]\x02 T{stub}{when.diff().in_words()}{vid}")
-    line = " ".join(lines)
-    lines = []
-    lines.append(line)
-    if rocket:
-        if landing:
-            lines.append(rocket + " " + landing)
-        else:
-            lines.append(rocket)
-    if vid: lines.append(f"\x02[Clock]\x02 T{stub}{when.diff().in_words()}{vid}")
+    return f"T{stub}{when.diff().in_words()}"
+
+def _fill_clock(lines, clock):
+    return [line.replace(CLOCK_MARK, clock) if CLOCK_MARK in line else line for line in lines]
+
+class RateLimited(IOError):
+    pass
+
+class RateLimiter:
+    """Token bucket allowing ``requests`` calls every ``per`` seconds."""
+
+    def __init__(self, requests, per):
+        self.capacity = requests
+        self.rate = requests / per
+        self.tokens = requests
+        self.updated = time.monotonic()
+        self.resume = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Refuses every call for the next ``seconds``, e.g. after a 429."""
+        with self._lock:
+            self.resume = max(self.resume, time.monotonic() + seconds)
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self.resume:
+                return False
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one call and its result."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            METRICS.incr('http_coalesced')
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
 
-    return lines
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+class HttpClient:
+    """Keep-alive session shared by every request the plugin makes.
+
+    Requests get a per-host timeout and a bounded retry with backoff. GET
+    responses carrying an ETag or Last-Modified header are remembered so the
+    next request for the same URL can be answered with a 304.
+
+    Identical requests in flight at the same time are made only once, and
+    each host has a request budget from RATE_LIMITS. Over budget, a GET falls
+    back to the last response seen for that URL and anything else raises
+    RateLimited."""
+
+    def __init__(self, retries=3, backoff=0.5, pool_size=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._validators = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._limiters = {host: RateLimiter(*limit) for host, limit in RATE_LIMITS.items()}
+
+    @property
+    def session(self):
+        # built on first use so loading the plugin doesn't import requests
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    from urllib3.util.retry import Retry
+                    # POST is only used for the SpaceX /query endpoint, which is
+                    # read-only, so retrying it is as safe as retrying a GET.
+                    # Retry-After is not slept on here, where it could hold a
+                    # provider thread for as long as the server likes; _timed
+                    # pauses the host's RateLimiter for it instead, capped.
+                    retry = Retry(
+                        total=self.retries,
+                        backoff_factor=self.backoff,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'POST']),
+                        respect_retry_after_header=False,
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    @staticmethod
+    def _timeout(url):
+        return HTTP_TIMEOUTS.get(urllib.parse.urlsplit(url).hostname, HTTP_DEFAULT_TIMEOUT)
+
+    def _allowed(self, url):
+        host = urllib.parse.urlsplit(url).hostname
+        limiter = self._limiters.get(host)
+        if limiter is None or limiter.acquire():
+            return True
+        METRICS.incr('http_rate_limited', host=host)
+        return False
+
+    def _timed(self, method, url, send):
+        host = urllib.parse.urlsplit(url).hostname
+        with METRICS.timer('http_request', host=host):
+            response = send()
+        METRICS.incr('http_requests', host=host, method=method, status=response.status_code)
+        retry_after = response.headers.get('Retry-After')
+        if response.status_code in (429, 503) and retry_after and retry_after.isdigit() and host in self._limiters:
+            self._limiters[host].pause(min(int(retry_after), RETRY_AFTER_CAP))
+        return response
+
+    def get_json(self, url):
+        return self._flights.do(('GET', url), lambda: self._get_json(url))
+
+    def post_json(self, url, payload):
+        key = ('POST', url, json.dumps(payload, sort_keys=True))
+        return self._flights.do(key, lambda: self._post_json(url, payload))
+
+    def _get_json(self, url):
+        headers = {}
+        cached = self._validators.get(url)
+        if not self._allowed(url):
+            if cached:
+                return cached[2]
+            raise RateLimited(f"Request budget for {url} exhausted")
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = self._timed('GET', url, lambda: self.session.get(url, headers=headers, timeout=self._timeout(url)))
+        if response.status_code == 304 and cached:
+            return cached[2]
+        response.raise_for_status()
+        data = response.json()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self._lock:
+                self._validators[url] = (etag, last_modified, data)
+        return data
+
+    def validators(self, url):
+        cached = self._validators.get(url)
+        return cached[:2] if cached else (None, None)
+
+    def remember(self, url, etag, last_modified, data):
+        """Seeds the validators for ``url``, e.g. from a copy kept on disk."""
+        if (etag or last_modified) and url not in self._validators:
+            with self._lock:
+                self._validators[url] = (etag, last_modified, data)
+
+    def _post_json(self, url, payload):
+        if not self._allowed(url):
+            raise RateLimited(f"Request budget for {url} exhausted")
+        response = self._timed('POST', url, lambda: self.session.post(url, json=payload, timeout=self._timeout(url)))
+        response.raise_for_status()
+        return response.json()
+
+HTTP = HttpClient()
 
 def _fetch_data(url):
     try:
-        data = requests.get(url).json()
+        data = HTTP.get_json(url)
         if data:
             return data
         else:
@@ -149,119 +618,332 @@ def _fetch_data(url):
     except:
         return None
 
+def _ref_id(ref):
+    # populated references come back as the full document
+    if isinstance(ref, dict):
+        return ref.get('id')
+    return ref
+
 def _fetch_launchpad(id):
-    url = (f"https://api.spacexdata.com/v4/launchpads/{id}")
+    url = ENTITY_URL.format(kind='launchpads', id=id)
     return _fetch_data(url)
 
 def _fetch_rocket(id):
-    url = (f"https://api.spacexdata.com/v4/rockets/{id}")
+    url = ENTITY_URL.format(kind='rockets', id=id)
     return _fetch_data(url)
 
 def _fetch_landpad(id):
-    url = (f"https://api.spacexdata.com/v4/landpads/{id}")
+    url = ENTITY_URL.format(kind='landpads', id=id)
     return _fetch_data(url)
 
 def _fetch_payload(id):
-    url = (f"https://api.spacexdata.com/v4/payloads/{id}")
+    url = ENTITY_URL.format(kind='payloads', id=id)
     return _fetch_data(url)
 
 def _fetch_core(id):
-    url = (f"https://api.spacexdata.com/v4/cores/{id}")
+    url = ENTITY_URL.format(kind='cores', id=id)
     return _fetch_data(url)
 
-def _parse_results_spacex(data, desc=None, idx=0, tz=None):
-    # parses data from API
-
-    lines = []
-
-    name = data['name']
-    launch_time = pendulum.parse(data['date_utc'])
-    from_now = launch_time - pendulum.now('UTC') 
+class EntityStore:
+    """SQLite copy of every SpaceX entity the resolver has seen.
+
+    Rows are only read when an entity is not in memory yet, so a restart
+    costs one indexed lookup per entity instead of an API call. Along with
+    the data each row keeps when it was fetched and the response's
+    validators, so going stale only means a conditional request."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entities ('
+                'kind TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, fetched REAL NOT NULL, '
+                'etag TEXT, last_modified TEXT, PRIMARY KEY (kind, id)) WITHOUT ROWID')
+
+    def get(self, kind, id):
+        """Returns ``(fetched, data, etag, last_modified)`` or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT fetched, data, etag, last_modified FROM entities WHERE kind = ? AND id = ?',
+                (kind, id)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2], row[3]
+
+    def put(self, kind, id, data, fetched, etag=None, last_modified=None):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, id, json.dumps(data, separators=(',', ':')), fetched, etag, last_modified))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class EntityResolver:
+    """Fetches the SpaceX entities a launch refers to, concurrently and with a
+    per-kind TTL cache.
+
+    With an EntityStore attached the cache survives restarts. Entities past
+    their TTL are still served while they are revalidated in the background,
+    so only ones never seen before are waited on."""
+
+    fetchers = {
+        'launchpads': _fetch_launchpad,
+        'rockets': _fetch_rocket,
+        'landpads': _fetch_landpad,
+        'payloads': _fetch_payload,
+        'cores': _fetch_core,
+    }
 
-    if (data['tbd'] or is_tbd(data['date_utc'])):
-        if (launch_time.month > pendulum.now('UTC').month): 
+    def __init__(self, workers=8):
+        self._cache = {kind: {} for kind in self.fetchers}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spacex-resolver')
+        self._store = None
+        self._revalidating = set()
+
+    def attach(self, store):
+        old, self._store = self._store, store
+        if old:
+            old.close()
+
+    def _cached(self, kind, id):
+        """Returns ``(expires, data)`` from memory, or failing that from disk."""
+        entry = self._cache[kind].get(id)
+        if entry or self._store is None:
+            return entry
+        try:
+            row = self._store.get(kind, id)
+        except sqlite3.Error:
+            LOGGER.exception("Couldn't read %s %s from the entity cache", kind, id)
+            return None
+        if row is None:
+            return None
+        fetched, value, etag, last_modified = row
+        HTTP.remember(ENTITY_URL.format(kind=kind, id=id), etag, last_modified, value)
+        # wall clock on disk, monotonic in memory
+        entry = (time.monotonic() + fetched + ENTITY_TTL[kind] - time.time(), value)
+        with self._lock:
+            self._cache[kind][id] = entry
+        return entry
+
+    def _remember(self, kind, id, value, fetched=False):
+        # failed lookups are not cached so they get retried next time
+        if not value:
+            return
+        with self._lock:
+            old = self._cache[kind].get(id)
+            self._cache[kind][id] = (time.monotonic() + ENTITY_TTL[kind], value)
+        # populated references turn up on every poll, only write them when they change
+        if self._store is None or not (fetched or old is None or old[1] != value):
+            return
+        etag, last_modified = HTTP.validators(ENTITY_URL.format(kind=kind, id=id)) if fetched else (None, None)
+        try:
+            self._store.put(kind, id, value, time.time(), etag, last_modified)
+        except sqlite3.Error:
+            LOGGER.exception("Couldn't write %s %s to the entity cache", kind, id)
+
+    def _revalidate(self, kind, id):
+        with self._lock:
+            if (kind, id) in self._revalidating:
+                return
+            self._revalidating.add((kind, id))
+
+        def fetch():
+            try:
+                value = self.fetchers[kind](id)
+                if value:
+                    self._remember(kind, id, value, fetched=True)
+                else:
+                    # keep serving what we have, but don't hammer an API that is down
+                    with self._lock:
+                        entry = self._cache[kind].get(id)
+                        if entry:
+                            self._cache[kind][id] = (time.monotonic() + ENTITY_RETRY, entry[1])
+            finally:
+                with self._lock:
+                    self._revalidating.discard((kind, id))
+
+        METRICS.incr('entity_revalidations', kind=kind)
+        self._pool.submit(fetch)
+
+    @staticmethod
+    def _references(launch):
+        yield 'launchpads', launch.get('launchpad')
+        yield 'rockets', launch.get('rocket')
+        for core in launch.get('cores') or []:
+            yield 'cores', core.get('core')
+            if core.get('landing_attempt'):
+                yield 'landpads', core.get('landpad')
+        for payload in launch.get('payloads') or []:
+            yield 'payloads', payload
+
+    def missing(self, launch, entities):
+        """Whether anything ``launch`` refers to is absent from ``entities``,
+        as returned by resolve()."""
+        return any(not entities[kind].get(_ref_id(ref)) for kind, ref in self._references(launch) if _ref_id(ref))
+
+    def resolve(self, launches):
+        """Returns ``{kind: {id: data}}`` for everything ``launches`` refer to.
+
+        References that were already populated by the query API are used as
+        they are and only bare IDs are looked up."""
+        found = {kind: {} for kind in self.fetchers}
+        missing = set()
+        now = time.monotonic()
+        for launch in launches:
+            for kind, ref in self._references(launch):
+                id = _ref_id(ref)
+                if not id or id in found[kind]:
+                    continue
+                if isinstance(ref, dict):
+                    self._remember(kind, id, ref)
+                    found[kind][id] = ref
+                    continue
+                entry = self._cached(kind, id)
+                if entry is None:
+                    METRICS.incr('entity_cache', kind=kind, result='miss')
+                    missing.add((kind, id))
+                    continue
+                expires, value = entry
+                METRICS.incr('entity_cache', kind=kind, result='hit')
+                if expires <= now:
+                    self._revalidate(kind, id)
+                found[kind][id] = value
+
+        futures = {(kind, id): self._pool.submit(self.fetchers[kind], id) for kind, id in missing}
+        for (kind, id), future in futures.items():
+            try:
+                value = future.result()
+            except Exception:
+                value = None
+            self._remember(kind, id, value, fetched=True)
+            found[kind][id] = value
+
+        return found
+
+RESOLVER = EntityResolver()
+
+Booster = namedtuple('Booster', 'serial flight landing')
+
+@dataclass(frozen=True)
+class Launch:
+    """One launch as any provider reports it, ready to render."""
+    __slots__ = ('provider', 'id', 'name', 'vehicle', 'when', 'net', 'tbd', 'precision', 'status',
+                 'probability', 'location', 'timezone', 'mission', 'boosters', 'payloads', 'webcasts', 'partial')
+    provider: str
+    id: str
+    name: str
+    vehicle: Optional[str]
+    # T-0 as an ISO timestamp; ``net`` if it is a no-earlier-than date, ``tbd``
+    # if only known to ``precision`` (month, quarter, ...)
+    when: str
+    net: bool
+    tbd: bool
+    precision: Optional[str]
+    status: Optional[str]
+    probability: Optional[int]
+    location: str
+    # the launch site's timezone, when known
+    timezone: Optional[str]
+    mission: Optional[str]
+    boosters: tuple
+    payloads: tuple
+    webcasts: tuple
+    # something it refers to couldn't be looked up, so it renders with placeholders
+    partial: bool
+
+def _render_launch(launch, tz=None):
+    # renders a Launch into lines with CLOCK_MARK for the countdown
+    tz = tz or launch.timezone or 'UTC'
+    if launch.tbd:
+        launch_time = _parse_time(launch.when)
+        if (launch_time.month > _now().month):
             when = "sometime in {}".format(launch_time.format('MMMM'))
         else:
-            when = "sometime this {}".format(data['date_precision'])
+            when = "sometime this {}".format(launch.precision or 'month')
     else:
-        if tz:
-            launch_time_utc = launch_time.in_tz(tz).format('MMM Do, h:mmA zz')
-        else:
-            launch_time_utc = launch_time.in_tz('UTC').format('MMM Do, H:mm zz')
-
-        launch_time_local = pendulum.parse(data['date_local']).format('MMM Do, h:mmA')
-        from_now_human = launch_time.diff_for_humans()
-
-        if data['net']:
-            when = "NET {} ({} local)".format(launch_time_utc, launch_time_local)
-        else:
-            when = "at {} ({} local), which is {}".format(launch_time_utc, launch_time_local, from_now_human)
-
-    launchpad_data = _fetch_launchpad(data['launchpad'])
-    location = launchpad_data['name'] if launchpad_data else "Unknown"
-
-    rocket_data = _fetch_rocket(data['rocket'])
-    rocket = rocket_data['name'] if rocket_data else "Unknown"
-    
-    lines.append(f"\x02{name}:\x02 {rocket} launch from {location} {when}")
-
-    cores = data['cores']
-    if cores:
-        for core in cores:
-            core_data = _fetch_core(core['core'])
-            serial = core_data['serial'] if core_data else "unknown"
-            flight = core['flight']
-            landing = "landing Unknown"
-            if core['landing_attempt']:
-                landing = "landing "
-                if core['landing_type'] == "RTLS":
-                    landing += "at "
-                else:
-                    landing += "on "
-
-                landpad_data = _fetch_landpad(core['landpad'])
-                if landpad_data:
-                    landing += landpad_data['full_name']
-                else:
-                    landing = "landing Unknown"           
-
-            lines.append(f"[First Stage] Core {serial}, flight #{flight} {landing}")
-    else:
-        lines.append(f"[First Stage] Unknown")
-
-    payloads = data['payloads']
-    for payload in payloads:
-        payload_data = _fetch_payload(payload)
-        if payload_data:
-            p_id = payload_data['name']
-            p_type = payload_data['type']
-            p_orbit = payload_data['orbit']
-            p_mass_kg = payload_data['mass_kg']
-            p_customer = payload_data.get('customers')
-            p_country = payload_data.get('nationalities')
-
-            if (not p_customer or not p_country):
-                customer = ""
-            else:
-                customer = f" for {p_customer[0]} of {p_country[0]}"
-
-            if (p_mass_kg is None):
-                weight = ""
-            else:
-                weight = " weighing "+str(p_mass_kg)+"kg"
-
-            lines.append(f"[Payload] {p_id} {p_type}{weight} to {p_orbit}{customer}")
-
-    if (not data['tbd']):
-        if (from_now.in_hours() < 4):
-            webcast = data.get('links').get('webcast') or "https://spacex.com/webcast"
-            lines.append(f"[Webcast] {webcast}")
-
-    return lines
+        when = color(_render_time(launch.when, tz, LAUNCH_TIME_FORMAT), 'cyan')
+        if launch.timezone and launch.timezone != tz:
+            when += f" ({_render_time(launch.when, launch.timezone, LOCAL_TIME_FORMAT)} local)"
+        if launch.net:
+            when = "NET " + when
+
+    vehicle = f" ({launch.vehicle})" if launch.vehicle else ""
+    line = f"\x02[Launch]\x02 {launch.name}{vehicle} from {launch.location} \x02[When]\x02 {when}"
+    if launch.status:
+        status = color(launch.status, "green") if "Go" in launch.status else launch.status
+        prob = f" ({launch.probability}%)" if launch.probability else ""
+        line += f" \x02[Status]\x02 {status}{prob}"
+    if launch.mission:
+        line += " \x02[Mission]\x02 " + launch.mission
+
+    lines = [line]
+    for booster in launch.boosters:
+        parts = [f"Core {booster.serial}" if booster.serial else None,
+                 f"flight #{booster.flight}" if booster.flight else None,
+                 booster.landing]
+        lines.append("[First Stage] " + ", ".join(filter(None, parts)))
+    for payload in launch.payloads:
+        lines.append(f"[Payload] {payload}")
+    clock = f"\x02[Clock]\x02 {CLOCK_MARK}"
+    if launch.webcasts:
+        clock += " \x02[Watch]\x02 {}".format(', '.join(launch.webcasts))
+    lines.append(clock)
+
+    return lines, launch.when, tz
+
+def _launch_lines(launch, tz=None):
+    lines, ts, tz = _render_launch(launch, tz)
+    return _fill_clock(lines, _clock(ts, tz))
+
+class ResponseCache:
+    """Finished reply lines for !launch and !spacex.
+
+    Entries are keyed on (command, provider, index, timezone, snapshot
+    revision, month) and keep CLOCK_MARK in place of the countdown, which is
+    the only part that is rendered again on a hit. The poller clears the
+    cache whenever the launches change.
+
+    ``render`` returns the entry and whether it may be kept. Renders with
+    lookups that failed are not, so the next reply retries them instead of
+    repeating "Unknown" until the launches change."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        METRICS.incr('response_cache', command=key[0], provider=key[1], result='miss' if entry is None else 'hit')
+        if entry is None:
+            with METRICS.timer('render', command=key[0], provider=key[1]):
+                entry, keep = render()
+            if keep:
+                with self._lock:
+                    self._entries[key] = entry
+                    if len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+        lines, ts, tz = entry
+        return _fill_clock(lines, _clock(ts, tz))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+RESPONSES = ResponseCache()
 
 
 @module.commands('launch')
 @module.example('!launch')
+@_timed('launch')
 def launch(bot, trigger):
     """Fetches next scheduled rocket launch."""
 
@@ -274,99 +956,721 @@ def launch(bot, trigger):
             if arg.strip().lower() == "--utc":
                 zone = "UTC"
                 args.pop(idx)
+    idx = 0
+    if args:
+        tmp_args = " ".join(args)
+        try:
+            idx = int(tmp_args.strip())-1
+        except ValueError:
+            idx = 0
+
+    _reply_launch(bot, trigger, 'launch', idx, zone)
+
+def _reply_launch(bot, trigger, command, idx, zone=None):
+    # the shared tail of !launch and !spacex: pick a provider, render from its snapshot
     channel_or_nick = tools.Identifier(trigger.nick)
     zone = zone or get_nick_timezone(bot.db, channel_or_nick)
     if not zone:
         channel_or_nick = tools.Identifier(trigger.sender)
         zone = get_channel_timezone(bot.db, channel_or_nick)
+    if zone:
+        SEEN_ZONES.add(zone)
 
-    b_url = "https://spacelaunchnow.me/api/3.3.0/launch/upcoming/?format=json&limit=5"
-    try:
-        data = requests.get(b_url).json()
-    except:
-        return bot.reply("I couldn't fetch data from the API")
-    
-    if not data.get("results"):
+    provider, launches, revision = POLLER.first(SOURCES[command], spacex_only=command == 'spacex')
+    if not launches:
         return bot.reply("No results returned from the API")
+    if not 0 <= idx < len(launches):
+        idx = 0
+    raw = launches[idx]
 
-    if args:
-        tmp_args = " ".join(args)
-        try:
-            parsed_data = _parse_results(data, idx=int(tmp_args.strip())-1, tz=zone)
-        except:
-            parsed_data = _parse_results(data, tz=zone)
-    else:
-        parsed_data = _parse_results(data, tz=zone)
+    # the month only matters to TBD launches ("sometime in June"), but it's cheap
+    key = (command, provider.name, idx, zone, revision, time.gmtime().tm_mon)
+
+    def render():
+        data = provider.detail(raw)
+        launch = provider.normalize(data or raw)
+        return _render_launch(launch, zone), data is not None and not launch.partial
+
+    parsed_data = RESPONSES.get(key, render)
 
     for line in parsed_data:
-        bot.say(line, max_messages=2)
+        _say(bot, line, max_messages=2)
+
+def fetch_spacex_launches(limit=SPACEX_SNAPSHOT_SIZE):
+    """Fetches the next ``limit`` launches with everything they refer to
+    populated, in a single request."""
+    query = {
+        "query": {"upcoming": True},
+        "options": {
+            "limit": limit,
+            "sort": {"flight_number": "asc"},
+            "populate": ["rocket", "launchpad", "payloads", "cores.core", "cores.landpad"],
+        },
+    }
+    try:
+        data = HTTP.post_json(SPACEX_QUERY_URL, query)
+        return data['docs']
+    except:
+        return None
 
-def fetch_spacex_data(idx=0):
-    b_url = "https://api.spacexdata.com/v4/launches/upcoming?offset="+str(idx)+"&limit=1"
+def fetch_sln_launches():
+    """Fetches upcoming Space Launch Now launches as the list endpoint has
+    them; detail records are fetched by SpaceLaunchNow.detail on demand."""
     try:
-        data = requests.get(b_url).json()
-        data = data[0]
+        return HTTP.get_json(SLN_UPCOMING_URL)
     except:
-        data = None
+        return None
+
+class LaunchProvider(ABC):
+    """A source of upcoming launches.
+
+    ``fetch()`` returns them as the API sends them, or None if it couldn't
+    be reached, and ``normalize()`` turns one of those into a Launch."""
+
+    name = None
+
+    @abstractmethod
+    def fetch(self):
+        """The upcoming launches as the API sends them, or None."""
+
+    @abstractmethod
+    def when(self, raw):
+        """T-0 of ``raw`` as an ISO timestamp."""
+
+    @abstractmethod
+    def is_spacex(self, raw):
+        """Whether ``raw`` is a SpaceX launch, for !spacex falling back to this provider."""
+
+    @abstractmethod
+    def normalize(self, raw):
+        """``raw`` as a Launch."""
+
+    def updated(self, launches):
+        """Called from the poller when a fetch brought new launches."""
+
+    def detail(self, raw):
+        """``raw`` with anything only a reply needs filled in, or None if
+        that couldn't be fetched."""
+        return raw
+
+class SpaceLaunchNow(LaunchProvider):
+    """Space Launch Now launches.
+
+    The poller only fetches the upcoming list, which is enough to schedule
+    polls and pick launches. The detail record a reply renders costs one
+    request per launch, so only the next launch's is fetched with the list,
+    on the poller thread. Others are fetched the first time a reply asks for
+    them, which waits PROVIDER_BUDGET at most before rendering the list
+    record instead. Detail records are kept until the list changes."""
+
+    name = 'sln'
+
+    def __init__(self, workers=2):
+        self._details = {}
+        # url -> its fetch in flight
+        self._pending = {}
+        # bumped when the list changes, so a fetch that started before is not kept
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spacex-sln')
+
+    def fetch(self):
+        data = fetch_sln_launches()
+        return data['results'] if data and data.get('results') else None
+
+    def updated(self, launches):
+        # the next launch is what most replies ask for; its detail record is
+        # fetched before the new list is swapped in, so those never wait
+        url = launches[0].get('url')
+        data = self._get(url) if url else None
+        with self._lock:
+            self._generation += 1
+            self._details = {url: data} if data is not None else {}
+
+    @staticmethod
+    def _get(url):
+        try:
+            return HTTP.get_json(url)
+        except:
+            return None
+
+    def _fetch_detail(self, url):
+        with self._lock:
+            future = self._pending.get(url)
+            if future is None:
+                future = self._pending[url] = self._pool.submit(self._load_detail, url, self._generation)
+        return future
+
+    def _load_detail(self, url, generation):
+        data = self._get(url)
+        with self._lock:
+            del self._pending[url]
+            # failures are not kept, so the next reply tries again
+            if data is not None and generation == self._generation:
+                self._details[url] = data
+        return data
+
+    def detail(self, raw):
+        url = raw.get('url')
+        if not url:
+            return raw
+        with self._lock:
+            data = self._details.get(url)
+        if data is not None:
+            return data
+        try:
+            return self._fetch_detail(url).result(PROVIDER_BUDGET)
+        except FutureTimeout:
+            METRICS.incr('provider_timeouts', provider=self.name)
+            return None
+
+    def when(self, raw):
+        return raw.get('net')
 
-    return data
+    def is_spacex(self, raw):
+        return raw['pad']['agency_id'] == SLN_SPACEX_AGENCY
+
+    def normalize(self, data):
+        vehicle, _, name = _normalizeWhitespace(data['name'].strip()).rpartition(' | ')
+        status = data['status']['name']
+        try:
+            mission = _normalizeWhitespace(data['mission']['description'])
+        except:
+            mission = None
+
+        boosters = ()
+        if self.is_spacex(data):
+            stages = data['rocket']['launcher_stage']
+            # Falcon 9; Falcon Heavy is TBD
+            if len(stages) == 1:
+                landing = stages[0]['landing']
+                boosters = (Booster(None, stages[0]['launcher_flight_number'],
+                                    landing['description'] if landing['attempt'] else None),)
+
+        return Launch(
+            provider=self.name,
+            id=str(data['id']),
+            name=name,
+            vehicle=vehicle or None,
+            when=data['net'],
+            net=False,
+            tbd=False,
+            precision=None,
+            status=None if status == "TBD" else status,
+            probability=data['probability'] if data['probability'] and data['probability'] > 0 else None,
+            location="{} ({})".format(data['pad']['name'], data['pad']['location']['name']),
+            timezone=SLN_TIMEZONES.get(data['pad']['location']['id']),
+            mission=mission,
+            boosters=boosters,
+            payloads=(),
+            webcasts=tuple(dict.fromkeys(data.get('vidURLs') or ())),
+            partial=False,
+        )
+
+class SpaceXAPI(LaunchProvider):
+    name = 'spacex'
+
+    def fetch(self):
+        return fetch_spacex_launches()
+
+    def when(self, raw):
+        return raw.get('date_utc')
+
+    def is_spacex(self, raw):
+        return True
+
+    def updated(self, launches):
+        # look up whatever the query could not populate now rather than at render time
+        RESOLVER.resolve(launches)
+        if HISTORY:
+            try:
+                HISTORY.record(launches)
+            except sqlite3.Error:
+                LOGGER.exception("Couldn't record the launch history")
+
+    @staticmethod
+    def _booster(core, entities):
+        core_data = entities['cores'].get(_ref_id(core['core']))
+        serial = core_data['serial'] if core_data else "unknown"
+        landing = "landing Unknown"
+        if core['landing_attempt']:
+            landpad_data = entities['landpads'].get(_ref_id(core['landpad']))
+            if landpad_data:
+                landing = ("landing at " if core['landing_type'] == "RTLS" else "landing on ") + landpad_data['full_name']
+        return Booster(serial, core['flight'], landing)
+
+    @staticmethod
+    def _payload(payload_data):
+        p_customer = payload_data.get('customers')
+        p_country = payload_data.get('nationalities')
+        if (not p_customer or not p_country):
+            customer = ""
+        else:
+            customer = f" for {p_customer[0]} of {p_country[0]}"
+
+        if (payload_data['mass_kg'] is None):
+            weight = ""
+        else:
+            weight = " weighing "+str(payload_data['mass_kg'])+"kg"
+
+        return f"{payload_data['name']} {payload_data['type']}{weight} to {payload_data['orbit']}{customer}"
+
+    def normalize(self, data):
+        entities = RESOLVER.resolve([data])
+        launchpad_data = entities['launchpads'].get(_ref_id(data['launchpad'])) or {}
+        rocket_data = entities['rockets'].get(_ref_id(data['rocket'])) or {}
+        payloads = (entities['payloads'].get(_ref_id(payload)) for payload in data['payloads'])
+        webcast = (data.get('links') or {}).get('webcast')
+
+        return Launch(
+            provider=self.name,
+            id=data['id'],
+            name=data['name'],
+            vehicle=rocket_data.get('name', "Unknown"),
+            when=data['date_utc'],
+            net=bool(data['net']),
+            tbd=bool(data['tbd'] or is_tbd(data['date_utc'])),
+            precision=data['date_precision'],
+            status=None,
+            probability=None,
+            location=launchpad_data.get('name', "Unknown"),
+            timezone=launchpad_data.get('timezone'),
+            mission=_normalizeWhitespace(data['details']) if data.get('details') else None,
+            boosters=tuple(self._booster(core, entities) for core in data['cores']) or (Booster(None, None, "Unknown"),),
+            payloads=tuple(self._payload(payload) for payload in payloads if payload),
+            webcasts=(webcast,) if webcast else (),
+            partial=RESOLVER.missing(data, entities),
+        )
+
+PROVIDERS = {provider.name: provider for provider in (SpaceLaunchNow(), SpaceXAPI())}
+
+class LaunchPoller(threading.Thread):
+    """Keeps the upcoming launches from every provider in memory so commands
+    never wait on the network.
+
+    Providers are fetched in parallel and each snapshot is swapped in as soon
+    as its own fetch finishes, so a slow API only ever delays itself. A
+    reply that finds nothing loaded waits PROVIDER_BUDGET at most, then
+    falls back to the next provider in SOURCES."""
+
+    def __init__(self):
+        super().__init__(name='spacex-poller', daemon=True)
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=len(PROVIDERS), thread_name_prefix='spacex-provider')
+        # provider name -> its fetch in flight
+        self._pending = {}
+        self.snapshots = dict.fromkeys(PROVIDERS)
+        # bumped whenever a snapshot changes
+        self.revision = 0
+
+    def _fetch(self, name):
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                future = self._pending[name] = self._pool.submit(self._update, name)
+        return future
+
+    def _update(self, name):
+        provider = PROVIDERS[name]
+        try:
+            with METRICS.timer('refresh', source=name):
+                launches = provider.fetch()
+            if launches is not None and launches != self.snapshots[name]:
+                provider.updated(launches)
+                with self._lock:
+                    self.snapshots[name] = launches
+                    self.revision += 1
+                RESPONSES.clear()
+        except Exception:
+            LOGGER.exception(f"Launch refresh from {name} failed")
+        finally:
+            with self._lock:
+                del self._pending[name]
+
+    def refresh(self, names=None, budget=None):
+        """Fetches ``names`` (every provider by default) in parallel,
+        waiting for them at most ``budget`` seconds."""
+        wait([self._fetch(name) for name in names or PROVIDERS], timeout=budget)
+        self.prerender()
+
+    def first(self, names, spacex_only=False):
+        """Returns ``(provider, launches, revision)`` for the first of
+        ``names`` with any, ``revision`` being the one those launches belong
+        to so a reply never caches old launches under a newer revision.
+
+        Providers with nothing loaded yet are fetched all at once, joining
+        any fetch already in flight, and the lot is waited on for
+        PROVIDER_BUDGET seconds in total. A provider that failed before is
+        simply tried again; HttpClient rate limits how often that can hit it."""
+        with self._lock:
+            futures = {name: self._pending.get(name) for name in names if self.snapshots[name] is None}
+        for name in futures:
+            futures[name] = futures[name] or self._fetch(name)
+
+        deadline = time.monotonic() + PROVIDER_BUDGET
+        for name in names:
+            if name in futures:
+                try:
+                    futures[name].result(max(0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    METRICS.incr('provider_timeouts', provider=name)
+            provider = PROVIDERS[name]
+            with self._lock:
+                launches, revision = self.snapshots[name], self.revision
+            if launches and spacex_only:
+                launches = [launch for launch in launches if provider.is_spacex(launch)]
+            if launches:
+                return provider, launches, revision
+        return None, [], self.revision
+
+    def prerender(self):
+        # fill the time caches for the next launch in every zone seen so far
+        firsts = [PROVIDERS[name].when(launches[0]) for name, launches in self.snapshots.items() if launches]
+        for tz in list(SEEN_ZONES):
+            try:
+                for when in filter(None, firsts):
+                    _render_time(when, tz, LAUNCH_TIME_FORMAT)
+            except Exception:
+                SEEN_ZONES.discard(tz)
+
+    def spacex_launches(self):
+        if self.snapshots['spacex'] is None:
+            self.refresh(['spacex'])
+        return self.snapshots['spacex'] or []
+
+    def _next_t0(self):
+        dates = [PROVIDERS[name].when(launches[0]) for name, launches in self.snapshots.items() if launches]
+
+        now = _now()
+        seconds = None
+        for date in filter(None, dates):
+            try:
+                delta = abs((_parse_time(date) - now).in_seconds())
+            except Exception:
+                continue
+            if seconds is None or delta < seconds:
+                seconds = delta
+        return seconds
+
+    def interval(self):
+        if None in self.snapshots.values():
+            return POLL_RETRY_INTERVAL
+        seconds = self._next_t0()
+        if seconds is not None:
+            for window, interval in POLL_INTERVALS:
+                if seconds < window:
+                    return interval
+        return POLL_IDLE_INTERVAL
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                LOGGER.exception("Launch refresh failed")
+            self._stopping.wait(self.interval())
+
+    def stop(self):
+        self._stopping.set()
+        self._pool.shutdown(wait=False)
+
+def fetch_spacex_data(idx=0):
+    launches = POLLER.spacex_launches()
+    if idx < len(launches):
+        return launches[idx]
+    return None
 
 @module.commands('spacex')
 @module.example('!spacex')
+@_timed('spacex')
 def spacex(bot, trigger):
     """Fetches next scheduled SpaceX rocket launch."""
 
     args = trigger.group(2)
+    if args and args.split()[0].lower() == 'history':
+        return spacex_history(bot, trigger, args.partition(' ')[2].strip())
     try:
-        idx = int(args)
-        if (idx < 0):
-            idx = 0
-
-        if (idx > 10):
-            idx = 10
-    except:
+        idx = min(max(int(args), 0), SPACEX_SNAPSHOT_SIZE - 1)
+    except (TypeError, ValueError):
         idx = 0
- #   print(args)
- #   if args: args = args.split()
-    zone = None
- #   if args:
- #       tmp_args = args
- #       for idx,arg in enumerate(tmp_args):
- #           if arg.strip().lower() == "--utc":
- #               zone = "UTC"
- #               args.pop(idx)
-    channel_or_nick = tools.Identifier(trigger.nick)
-    zone = zone or get_nick_timezone(bot.db, channel_or_nick)
-    if not zone:
-        channel_or_nick = tools.Identifier(trigger.sender)
-        zone = get_channel_timezone(bot.db, channel_or_nick)
 
-    data = fetch_spacex_data(idx)
+    _reply_launch(bot, trigger, 'spacex', idx)
 
-    if not data:
-        return bot.reply("No results returned from the API")
+Change = namedtuple('Change', 'kind launch_id text')
 
-    parsed_data = _parse_results_spacex(data, "SpaceX", tz=zone)
+class ScheduleDiff:
+    """Works out what changed between two snapshots of the next launches.
 
-    for line in parsed_data:
-        bot.say(line, max_messages=2)
+    Each launch is reduced to a hash of the fields worth announcing (NET,
+    boosters, landings), so unchanged launches cost one comparison and only
+    changed ones get their entities resolved and described. Launches that
+    only enter or leave the window because others moved are not reported."""
+
+    def __init__(self):
+        self._launches = None
+
+    @staticmethod
+    def _fingerprint(launch):
+        cores = tuple(
+            (_ref_id(core.get('core')), core.get('landing_attempt'), core.get('landing_type'), _ref_id(core.get('landpad')))
+            for core in launch.get('cores') or []
+        )
+        return hash((launch.get('name'), launch.get('date_utc'), launch.get('tbd'), launch.get('net'), cores))
+
+    @staticmethod
+    def _when(launch):
+        if launch.get('tbd') or is_tbd(launch['date_utc']):
+            return "TBD"
+        return _render_time(launch['date_utc'], None, SPACEX_UTC_FORMAT)
+
+    @staticmethod
+    def _boosters(launch, entities):
+        boosters = []
+        for core in launch.get('cores') or []:
+            core_data = entities['cores'].get(_ref_id(core.get('core')))
+            serial = core_data['serial'] if core_data else "unknown"
+            if not core.get('landing_attempt'):
+                landing = "no landing"
+            else:
+                landpad_data = entities['landpads'].get(_ref_id(core.get('landpad')))
+                landing = landpad_data['full_name'] if landpad_data else "Unknown"
+            boosters.append((serial, landing))
+        return boosters
+
+    def _describe(self, old, new):
+        name = new['name']
+        changes = []
+        if old['date_utc'] != new['date_utc'] or old.get('tbd') != new.get('tbd'):
+            changes.append(Change('net', new['id'], f"{name} NET moved from {self._when(old)} to {self._when(new)}"))
+
+        old_boosters = self._boosters(old, RESOLVER.resolve([old]))
+        new_boosters = self._boosters(new, RESOLVER.resolve([new]))
+        old_serials = [serial for serial, _ in old_boosters]
+        new_serials = [serial for serial, _ in new_boosters]
+        if old_serials != new_serials:
+            changes.append(Change('booster', new['id'], f"{name} booster changed from {', '.join(old_serials) or 'unknown'} to {', '.join(new_serials) or 'unknown'}"))
+        elif old_boosters != new_boosters:
+            for (serial, was), (_, now) in zip(old_boosters, new_boosters):
+                if was != now:
+                    changes.append(Change('landing', new['id'], f"{name} core {serial} landing changed from {was} to {now}"))
+        if not changes and old['name'] != name:
+            changes.append(Change('renamed', new['id'], f"{old['name']} is now called {name}"))
+        return changes
+
+    def update(self, launches):
+        """Records ``launches`` and returns what changed since the last call."""
+        current = {launch['id']: (self._fingerprint(launch), launch) for launch in launches}
+        previous, self._launches = self._launches, current
+        if previous is None:
+            return []
+
+        # the snapshot is the first SPACEX_SNAPSHOT_SIZE launches by flight number
+        # (see fetch_spacex_launches), so that is what decides who is inside it
+        def last_flight(snapshot):
+            return max((launch['flight_number'] for _, launch in snapshot.values()), default=0)
+
+        changes = []
+        for id, (fingerprint, launch) in current.items():
+            old = previous.get(id)
+            if old is None:
+                if len(previous) < SPACEX_SNAPSHOT_SIZE or launch['flight_number'] <= last_flight(previous):
+                    changes.append(Change('new', id, f"{launch['name']} was added to the manifest, NET {self._when(launch)}"))
+            elif old[0] != fingerprint:
+                changes.extend(self._describe(old[1], launch))
+
+        now = _now()
+        for id, (_, launch) in previous.items():
+            if id in current or _parse_time(launch['date_utc']) < now:
+                # launches that have flown just drop off the upcoming list
+                continue
+            if len(current) < SPACEX_SNAPSHOT_SIZE or launch['flight_number'] <= last_flight(current):
+                changes.append(Change('removed', id, f"{launch['name']} was removed from the manifest"))
+        return changes
+
+HistoryEvent = namedtuple('HistoryEvent', 'observed kind launch')
+
+class LaunchHistory:
+    """Append-only SQLite log of every version of every launch the poller saw.
+
+    Each poll appends one event per launch that is new ('seen'), had its NET
+    moved ('net') or changed in any other way ('updated'), carrying a slim
+    copy of the launch. Events are indexed by launch ID, name, vehicle, pad
+    and NET, so history and slip counts never need the upstream APIs."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # launch ID -> the copy last written, so unchanged launches aren't appended again
+        self._last = {}
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'seq INTEGER PRIMARY KEY, launch_id TEXT NOT NULL, observed TEXT NOT NULL, kind TEXT NOT NULL, '
+                'name TEXT, rocket TEXT, launchpad TEXT, date_utc TEXT, data TEXT NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS events_launch ON events (launch_id, seq)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS events_name ON events (name COLLATE NOCASE)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS events_rocket ON events (rocket, date_utc)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS events_launchpad ON events (launchpad, date_utc)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS events_date ON events (date_utc)')
+
+    @staticmethod
+    def _snapshot(launch):
+        # plain JSON types only, so it compares equal to what comes back from the table
+        return {
+            'name': launch.get('name'),
+            'flight_number': launch.get('flight_number'),
+            'date_utc': launch.get('date_utc'),
+            'date_precision': launch.get('date_precision'),
+            'tbd': launch.get('tbd'),
+            'net': launch.get('net'),
+            'rocket': _ref_id(launch.get('rocket')),
+            'launchpad': _ref_id(launch.get('launchpad')),
+            'cores': [[_ref_id(core.get('core')), core.get('landing_attempt'), _ref_id(core.get('landpad'))]
+                      for core in launch.get('cores') or []],
+            'payloads': [_ref_id(payload) for payload in launch.get('payloads') or []],
+        }
+
+    def record(self, launches):
+        """Appends an event for each launch that changed since it was last recorded."""
+        observed = _now().to_iso8601_string()
+        rows = []
+        with self._lock, self._db:
+            for launch in launches:
+                id = launch['id']
+                snapshot = self._snapshot(launch)
+                last = self._last.get(id)
+                if last is None:
+                    row = self._db.execute(
+                        'SELECT data FROM events WHERE launch_id = ? ORDER BY seq DESC LIMIT 1', (id,)).fetchone()
+                    last = json.loads(row[0]) if row else None
+                if last == snapshot:
+                    self._last[id] = last
+                    continue
+                if last is None:
+                    kind = 'seen'
+                elif last['date_utc'] != snapshot['date_utc']:
+                    kind = 'net'
+                else:
+                    kind = 'updated'
+                rows.append((id, observed, kind, snapshot['name'], snapshot['rocket'], snapshot['launchpad'],
+                             snapshot['date_utc'], json.dumps(snapshot, separators=(',', ':'))))
+                self._last[id] = snapshot
+            self._db.executemany(
+                'INSERT INTO events (launch_id, observed, kind, name, rocket, launchpad, date_utc, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        METRICS.incr('history_events', len(rows))
+        return len(rows)
+
+    def find(self, name):
+        """Returns the ID of the launch last seen called ``name``, or containing it."""
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', name) + '%'
+        with self._lock:
+            row = (self._db.execute(
+                       'SELECT launch_id FROM events WHERE name = ? COLLATE NOCASE ORDER BY seq DESC LIMIT 1',
+                       (name,)).fetchone() or
+                   self._db.execute(
+                       "SELECT launch_id FROM events WHERE name LIKE ? ESCAPE '\\' ORDER BY seq DESC LIMIT 1",
+                       (pattern,)).fetchone())
+        return row[0] if row else None
+
+    def events(self, launch_id):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT observed, kind, data FROM events WHERE launch_id = ? ORDER BY seq', (launch_id,)).fetchall()
+        return [HistoryEvent(observed, kind, json.loads(data)) for observed, kind, data in rows]
+
+    def most_slipped(self, since, limit=5):
+        """Returns ``(name, slips)`` for the launches now NET after ``since`` that moved the most."""
+        with self._lock:
+            # judged by each launch's latest event, so launches that have flown drop out
+            return self._db.execute(
+                'SELECT latest.name, COUNT(*) AS slips FROM events AS latest '
+                "JOIN events AS slip ON slip.launch_id = latest.launch_id AND slip.kind = 'net' "
+                'WHERE latest.seq IN (SELECT MAX(seq) FROM events GROUP BY launch_id) AND latest.date_utc >= ? '
+                'GROUP BY latest.launch_id ORDER BY slips DESC LIMIT ?', (since, limit)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def _net_trail(events, limit=8):
+    dates = [ScheduleDiff._when(event.launch) for event in events if event.kind in ('seen', 'net')]
+    if len(dates) > limit:
+        dates = ['…'] + dates[-limit:]
+    return ' → '.join(dates)
+
+def _lookup_history(bot, name):
+    if HISTORY is None:
+        bot.reply("The launch history isn't available")
+        return None
+    launch_id = HISTORY.find(name)
+    events = HISTORY.events(launch_id) if launch_id else []
+    if not events:
+        bot.reply(f"No launch matching {name} in the history")
+    return events
+
+def spacex_history(bot, trigger, name):
+    """Shows what the bot has recorded about a launch, for !spacex history <name>."""
+    if not name:
+        return bot.reply("Usage: !spacex history <name>")
+    events = _lookup_history(bot, name)
+    if not events:
+        return
+    launch = events[-1].launch
+    entities = RESOLVER.resolve([{'rocket': launch['rocket'], 'launchpad': launch['launchpad']}])
+    rocket = (entities['rockets'].get(launch['rocket']) or {}).get('name', 'Unknown rocket')
+    pad = (entities['launchpads'].get(launch['launchpad']) or {}).get('name', 'Unknown pad')
+    slips = sum(event.kind == 'net' for event in events)
+    _say(bot, f"\x02{launch['name']}\x02 ({rocket}, {pad}) first seen {_render_time(events[0].observed, None, SPACEX_UTC_FORMAT)}, "
+              f"{len(events) - 1} update{'' if len(events) == 2 else 's'} since, {slips} to the NET", max_messages=2)
+    _say(bot, f"NET: {_net_trail(events)}", max_messages=2)
+
+@module.commands('slips')
+@module.example('!slips Starlink 6-14')
+@_timed('slips')
+def slips(bot, trigger):
+    """Shows how many times a launch's NET has moved, or which upcoming launches moved the most."""
+    name = (trigger.group(2) or '').strip()
+    if not name:
+        if HISTORY is None:
+            return bot.reply("The launch history isn't available")
+        slipped = HISTORY.most_slipped(_now().to_iso8601_string())
+        if not slipped:
+            return bot.reply("No upcoming launch has slipped yet")
+        return _say(bot, "Most slipped: " + ", ".join(f"{name} ({count})" for name, count in slipped))
+
+    events = _lookup_history(bot, name)
+    if not events:
+        return
+    launch = events[-1].launch
+    count = sum(event.kind == 'net' for event in events)
+    since = _render_time(events[0].observed, None, SPACEX_UTC_FORMAT)
+    if not count:
+        return _say(bot, f"\x02{launch['name']}\x02 hasn't moved since it was first seen {since}, NET {ScheduleDiff._when(launch)}")
+    _say(bot, f"\x02{launch['name']}\x02 NET moved {count} time{'' if count == 1 else 's'} since {since}: {_net_trail(events)}",
+         max_messages=2)
 
 @module.interval(300)
+@_timed('periodic_spacex')
 def periodic_spacex(bot):
     global LOGGER
+    if not READY.wait(60):
+        return
     data = fetch_spacex_data(0)
 
     if not data:
         return
 
-    launch_time = pendulum.parse(data['date_utc'])
+    launch_time = _parse_time(data['date_utc'])
     if (data.get('tbd') or is_tbd(data['date_utc'])):
-        if (launch_time.month > pendulum.now('UTC').month): 
+        if (launch_time.month > _now().month): 
             launch_date = "sometime in {}".format(launch_time.format('MMMM'))
         else:
             launch_date = "sometime this {}".format(data['date_precision'])
     else:
-        launch_date = (f"{launch_time.format('MMM Do, H:mm zz')}")
+        launch_date = _render_time(data['date_utc'], None, SPACEX_UTC_FORMAT)
 
     #topic_orig = bot.channels[tools.Identifier('#kyle')].topic
     topic_orig = bot.channels[tools.Identifier(bot.config.spacex.channel)].topic
@@ -381,57 +1685,158 @@ def periodic_spacex(bot):
             bot.write(('TOPIC', bot.config.spacex.channel + ' :' + new_topic))
             #bot.write(('TOPIC', '#kyle' + ' :' + new_topic))
 
-    nextlaunch = bot.db.get_plugin_value("spacex", "nextlaunch")
-    nextlaunch_date = bot.db.get_plugin_value("spacex", "nextlaunch_date")
-    nextlaunch_name = bot.db.get_plugin_value("spacex", "nextlaunch_name")
-    bot.say(f"periodic_spacex: [{nextlaunch}]=[{data['flight_number']}] [{nextlaunch_date}]=[{data['date_utc']}]", "#kyle")
+    nextlaunch = STATE.nextlaunch
+    nextlaunch_date = STATE.nextlaunch_date
+    nextlaunch_name = STATE.nextlaunch_name
+    LOGGER.debug(f"periodic_spacex: [{nextlaunch}]=[{data['flight_number']}] [{nextlaunch_date}]=[{data['date_utc']}]")
+    announced = None
     if (nextlaunch):
         line = None
 
         if (nextlaunch != data['flight_number']):
             line = (f"\x02[SpaceX Schedule Update]\x02 A new Mission has been scheduled next. Was: {nextlaunch_name} Now: {data['name']}") 
         elif (nextlaunch_date != data['date_utc']):
-            line = (f"\x02[SpaceX Schedule Update]\x02 A new Launch Time has been established. Was: {pendulum.parse(nextlaunch_date).format('MMM Do, H:mm zz')} Now: {launch_date}") 
+            line = (f"\x02[SpaceX Schedule Update]\x02 A new Launch Time has been established. Was: {_render_time(nextlaunch_date, None, SPACEX_UTC_FORMAT)} Now: {launch_date}") 
+            announced = data['id']
             
         if line:
-            bot.say(line, bot.config.spacex.channel, max_messages=2)
+            _say(bot, line, bot.config.spacex.channel, max_messages=2)
             
-            parsed_data = _parse_results_spacex(data, "SpaceX", tz="UTC")
+            parsed_data = _launch_lines(PROVIDERS['spacex'].normalize(data), tz="UTC")
             for line in parsed_data:
-                bot.say(line, bot.config.spacex.channel, max_messages=2)
+                _say(bot, line, bot.config.spacex.channel, max_messages=2)
 
-    bot.db.set_plugin_value("spacex", "nextlaunch", data['flight_number'])
-    bot.db.set_plugin_value("spacex", "nextlaunch_date", data['date_utc'])
-    bot.db.set_plugin_value("spacex", "nextlaunch_name", data['name'])
-    webcast = data.get('links').get('webcast') or "https://spacex.com/webcast"
-    bot.db.set_plugin_value("spacex", "nextlaunch_webcast", webcast)
-
-@module.interval(5)
-def periodic_time_check(bot):
-    nextlaunch_date = bot.db.get_plugin_value("spacex", "nextlaunch_date")
-    nextlaunch_name = bot.db.get_plugin_value("spacex", "nextlaunch_name")
-    nextlaunch_webcast = bot.db.get_plugin_value("spacex", "nextlaunch_webcast")
-
-    if (nextlaunch_date and not is_tbd(nextlaunch_date)):
-        launchdate = pendulum.parse(nextlaunch_date).format('MMM Do, H:mm zz')
-        delta = pendulum.parse(nextlaunch_date) - pendulum.now()
-        delta = delta.in_seconds()
-
-        #bot.say(f"periodic_time_check: [{launchdate}] [{delta}]", "#kyle")
-        #topic = target.Channel('#spacex').topic
-        #bot.say(f"{topic}", "#kyle")
+    # the rest of the manifest; a NET change of the next launch was announced above
+    changes = [change for change in DIFF.update(POLLER.spacex_launches())
+               if not (change.kind == 'net' and change.launch_id == announced)]
+    for change in changes[:SCHEDULE_UPDATE_LIMIT]:
+        _say(bot, f"\x02[SpaceX Schedule Update]\x02 {change.text}", bot.config.spacex.channel, max_messages=2)
+    if len(changes) > SCHEDULE_UPDATE_LIMIT:
+        _say(bot, f"\x02[SpaceX Schedule Update]\x02 ...and {len(changes) - SCHEDULE_UPDATE_LIMIT} more changes", bot.config.spacex.channel)
 
-        line = None
-        if (delta < 3603 and delta > 3597):
-            line = (f"\x02[Launch Alert]\x02 SpaceX launch of {nextlaunch_name} is scheduled to lift off in 1 hour at {launchdate}!")
-        elif (delta < 1803 and delta > 1797):
-            line = (f"\x02[Launch Alert]\x02 SpaceX launch of {nextlaunch_name} is scheduled to lift off in 30 minutes at {launchdate}!")
-        elif (delta < 603 and delta > 597):
-            line = (f"\x02[Launch Alert]\x02 SpaceX launch of {nextlaunch_name} is scheduled to lift off in 10 minutes at {launchdate}!")
-        elif (delta < 63 and delta > 57):
-            line = (f"\x02[Launch Alert]\x02 SpaceX launch of {nextlaunch_name} is scheduled to lift off in 1 minute at {launchdate}!")
-
-        if (line):
-            line += (f" Watch here: {nextlaunch_webcast}")
-            bot.say(line, "#spacex", max_messages=2)
+    webcast = data.get('links').get('webcast') or "https://spacex.com/webcast"
+    STATE.update(
+        bot.db,
+        nextlaunch=data['flight_number'],
+        nextlaunch_date=data['date_utc'],
+        nextlaunch_name=data['name'],
+        nextlaunch_webcast=webcast,
+    )
+
+    SCHEDULER.arm(data['date_utc'], data['name'], webcast)
+
+class CountdownScheduler(threading.Thread):
+    """Sends the T-minus launch alerts for the next launch.
+
+    Alert times are worked out once whenever the launch changes and kept in
+    a heap; the thread sleeps until the earliest one is due. Every alert is
+    remembered by (launch date, offset) so re-arming with the same date never
+    sends it twice. That holds even when only the name or webcast changed:
+    the new details are used for the alerts still to come, and the ones
+    already sent are not repeated."""
+
+    # wake up at least this often to pick up wall clock adjustments
+    max_sleep = 600
+
+    def __init__(self, bot):
+        super().__init__(name='spacex-countdown', daemon=True)
+        self.bot = bot
+        self._cond = threading.Condition()
+        self._heap = []
+        self._fired = set()
+        self._launch = None
+        self._stopping = False
+
+    def arm(self, date_utc, name, webcast):
+        with self._cond:
+            if self._launch == (date_utc, name, webcast):
+                return
+            self._launch = (date_utc, name, webcast)
+            self._fired = {key for key in self._fired if key[0] == date_utc}
+            self._heap = []
+            if date_utc and not is_tbd(date_utc):
+                t0 = _parse_time(date_utc).timestamp()
+                for offset, wording in ALERTS:
+                    if (date_utc, offset) not in self._fired:
+                        heapq.heappush(self._heap, (t0 - offset, offset, wording))
+            self._cond.notify()
+
+    def _next_alert(self):
+        # blocks until an alert is due, returns None once stopped
+        with self._cond:
+            while not self._stopping:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                fire_at, offset, wording = self._heap[0]
+                delay = fire_at - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, self.max_sleep))
+                    continue
+                heapq.heappop(self._heap)
+                date_utc, name, webcast = self._launch
+                self._fired.add((date_utc, offset))
+                if -delay > ALERT_GRACE:
+                    continue
+                return date_utc, name, webcast, wording
+        return None
 
+    def run(self):
+        while True:
+            alert = self._next_alert()
+            if alert is None:
+                return
+            date_utc, name, webcast, wording = alert
+            try:
+                launchdate = _render_time(date_utc, None, SPACEX_UTC_FORMAT)
+                line = (f"\x02[Launch Alert]\x02 SpaceX launch of {name} is scheduled to lift off in {wording} at {launchdate}!")
+                line += (f" Watch here: {webcast}")
+                _say(self.bot, line, ALERT_CHANNEL, max_messages=2)
+            except Exception:
+                # one lost alert, not the thread
+                LOGGER.exception(f"Couldn't send the {wording} launch alert for {name}")
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+@module.interval(60)
+def dump_metrics(bot):
+    path = bot.config.spacex.metrics_file
+    if not path:
+        return
+    registry = bot.memory.get('metrics', {})
+    snapshot = {'time': time.time(), 'plugins': {plugin: metrics.snapshot() for plugin, metrics in registry.items()}}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+def _hit_rate(name):
+    hits = METRICS.total(name, result='hit')
+    total = hits + METRICS.total(name, result='miss')
+    return f"{100 * hits / total:.0f}%" if total else "n/a"
+
+@module.commands('spacexstats')
+@module.require_admin
+def spacexstats(bot, trigger):
+    """Shows command latency, upstream calls and cache hit rates."""
+    timers = {}
+    for timer in METRICS.snapshot()['timers']:
+        if timer['name'] == 'command':
+            timers[timer['labels']['command']] = timer
+    commands = ", ".join(
+        f"{name} {timer['count']}x avg {1000 * timer['sum'] / timer['count']:.1f}ms max {1000 * timer['max']:.1f}ms"
+        for name, timer in sorted(timers.items())
+    )
+    bot.reply(f"Commands: {commands or 'none yet'}")
+
+    hosts = sorted({c['labels']['host'] for c in METRICS.snapshot()['counters'] if c['name'] == 'http_requests'})
+    upstream = ", ".join(
+        f"{host} {METRICS.total('http_requests', host=host)} ({METRICS.total('http_requests', host=host, status=304)} not modified, "
+        f"{METRICS.total('http_rate_limited', host=host)} rate limited)"
+        for host in hosts
+    )
+    bot.reply(f"Upstream: {upstream or 'no requests yet'}, {METRICS.total('http_coalesced')} coalesced. "
+              f"Cache hits: responses {_hit_rate('response_cache')}, entities {_hit_rate('entity_cache')}")
@@ -1,14 +1,53 @@
 from sopel import module, tools
-from sopel.config.types import StaticSection, ValidatedAttribute, ListAttribute, NO_DEFAULT
-from twython import TwythonStreamer
+from sopel.config.types import StaticSection, ValidatedAttribute, ListAttribute, ChoiceAttribute, NO_DEFAULT
+import collections
+import contextlib
+import functools
 import html
+import random
+import re
+import threading
+import time
 
-api = None
-myStream = None
-myStreamListener = None
-sopel_instance = None
-firstStart = True
 LOGGER = None
+DEDUP = None
+QUEUE = None
+ROUTES = None
+SUPERVISOR = None
+
+# words as the streaming API tokenizes them for track matching
+TOKEN_RE = re.compile(r'[#@$]?\w+')
+WHITESPACE_RE = re.compile(r'\s+')
+URL_RE = re.compile(r'https?://\S+')
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+# a line is 512 bytes including CRLF; the server also prepends our
+# ":nick!user@host " when relaying, so keep some room for that
+IRC_LINE_BYTES = 512
+IRC_PREFIX_BYTES = 100
+
+@functools.lru_cache(maxsize=None)
+def _irc_budget(target):
+    return IRC_LINE_BYTES - IRC_PREFIX_BYTES - len(f"PRIVMSG {target} :\r\n".encode('utf-8'))
+
+def _truncate_bytes(text, limit):
+    encoded = text.encode('utf-8')
+    if len(encoded) <= limit:
+        return text
+    # cut on a character boundary, leaving room for the ellipsis
+    return encoded[:limit - 3].decode('utf-8', 'ignore') + '…'
+
+def _positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError("must be at least 1")
+    return value
+
+def _clean_text(text):
+    return WHITESPACE_RE.sub(' ', html.unescape(text)).strip()
+
+def _format_tweet(name, screen_name, text, limit):
+    return _truncate_bytes(f"\x02{name} (@{screen_name})\x02 {_clean_text(text)}", limit)
 
 class TwitterSection(StaticSection):
     consumer_key = ValidatedAttribute('consumer_key', default=NO_DEFAULT)
@@ -18,7 +57,59 @@ class TwitterSection(StaticSection):
     twitter_channel = ValidatedAttribute('twitter_channel', default=NO_DEFAULT)
     twitter_follow = ListAttribute('twitter_follow', strip=True, default=None)
     twitter_query = ListAttribute('twitter_query', strip=True, default=None)
+    twitter_routes = ListAttribute('twitter_routes', strip=True, default=None)
+    twitter_queue_size = ValidatedAttribute('twitter_queue_size', _positive_int, default=20)
+    twitter_overflow = ChoiceAttribute('twitter_overflow', choices=['drop_oldest', 'coalesce'], default='drop_oldest')
+    twitter_dedup_window = ValidatedAttribute('twitter_dedup_window', int, default=900)
+    twitter_burst_window = ValidatedAttribute('twitter_burst_window', int, default=3)
+
+
+class RelayMetrics:
+    """Counters and timings for the relay.
+
+    Registered in ``bot.memory['metrics']``, where the spacex plugin's
+    metrics endpoint and file export every plugin's ``snapshot()``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._timers = {}
+        self._gauges = {}
+
+    def incr(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                count, total, peak = self._timers.get(name, (0, 0.0, 0.0))
+                self._timers[name] = (count + 1, total + seconds, max(peak, seconds))
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def total(self, name):
+        with self._lock:
+            return sum(value for (key, _), value in self._counters.items() if key == name)
+
+    def snapshot(self):
+        with self._lock:
+            counters = list(self._counters.items())
+            timers = list(self._timers.items())
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+            'gauges': [{'name': name, 'labels': {}, 'value': fn()} for name, fn in list(self._gauges.items())],
+            'timers': [{'name': name, 'labels': {}, 'count': count, 'sum': total, 'max': peak}
+                       for name, (count, total, peak) in timers],
+        }
 
+METRICS = RelayMetrics()
 
 def configure(config):
     config.define_section('twittertwython', TwitterSection, validate=False)
@@ -33,14 +124,288 @@ def configure(config):
 
 def setup(bot):
     global LOGGER
+    global DEDUP
+    global QUEUE
     bot.config.define_section('twittertwython', TwitterSection)
     LOGGER = tools.get_logger('twittertwython')
 
-class MyStreamer(TwythonStreamer):
-    global sopel_instance
-    global LOGGER
+    global ROUTES
+    ROUTES = RoutingTable.from_config(bot.config.twittertwython)
+
+    DEDUP = TweetDeduper(bot.config.twittertwython.twitter_dedup_window)
+    QUEUE = OutboundQueue(bot, bot.config.twittertwython.twitter_queue_size,
+                          bot.config.twittertwython.twitter_overflow,
+                          bot.config.twittertwython.twitter_burst_window)
+    QUEUE.start()
+
+    METRICS.gauge('queue_depth', lambda: QUEUE.depth)
+    METRICS.gauge('tweets_dropped', lambda: QUEUE.dropped)
+    METRICS.gauge('dedup_entries', lambda: len(DEDUP))
+    bot.memory.setdefault('metrics', {})['twittertwython'] = METRICS
+
+    # after a reload, or loading into a bot that is already connected, 001 won't come again
+    if bot.connection_registered:
+        _start_supervisor(bot)
+
+def shutdown(bot):
+    if SUPERVISOR:
+        SUPERVISOR.stop()
+    if QUEUE:
+        QUEUE.stop()
+
+class RoutingTable:
+    """Maps followed user IDs and track terms to the channels that want them.
+
+    All routes share one stream. Lookups are a set lookup for the author plus
+    one dict lookup per word of the tweet, so the cost per tweet does not
+    grow with the number of rules.
+
+    The stream also delivers tweets that matched through a quoted tweet, a
+    retweet, a mention or an expanded URL. Without twitter_routes those all
+    go to the default channel as they always did; with routes, a tweet that
+    matches none of them is dropped rather than leaked there."""
+
+    def __init__(self, default_channel):
+        self.default_channel = default_channel
+        self.users = {}
+        self.terms = {}
+        self.phrases = {}
+        self.routed = False
+
+    @classmethod
+    def from_config(cls, section):
+        table = cls(section.twitter_channel)
+        for user_id in section.twitter_follow or []:
+            table.add(section.twitter_channel, user_id)
+        for term in section.twitter_query or []:
+            table.add(section.twitter_channel, term)
+        # each route is "channel: id-or-term id-or-term ..."; a line starting
+        # with "#" would be a comment to the config parser, so the "#" is optional
+        for route in section.twitter_routes or []:
+            channel, sep, rules = route.partition(':')
+            channel = channel.strip()
+            if not sep or not channel or not rules.split():
+                LOGGER.warning("Ignoring twitter_routes entry %r, expected \"channel: id-or-term ...\"", route)
+                continue
+            if channel[0] not in '#&':
+                channel = '#' + channel
+            table.routed = True
+            for rule in rules.split():
+                table.add(channel, rule)
+            LOGGER.info("Routing %s to %s", ", ".join(rules.split()), channel)
+        return table
+
+    def add(self, channel, rule):
+        if rule.isdigit():
+            self.users.setdefault(rule, set()).add(channel)
+            return
+        words = rule.lower().split()
+        if len(words) == 1:
+            self.terms.setdefault(words[0], set()).add(channel)
+        else:
+            # a phrase matches when all of its words are in the tweet
+            phrases = self.phrases.setdefault(words[0], {})
+            phrases.setdefault(frozenset(words), set()).add(channel)
+
+    @property
+    def follow(self):
+        return list(self.users)
+
+    @property
+    def track(self):
+        phrases = [" ".join(sorted(words)) for group in self.phrases.values() for words in group]
+        return list(self.terms) + phrases
+
+    def channels(self, user_id, text):
+        channels = set(self.users.get(user_id, ()))
+        tokens = set()
+        for token in TOKEN_RE.findall(text.lower()):
+            tokens.add(token)
+            if token[0] in '#@$':
+                # a plain term also matches its hashtag or mention
+                tokens.add(token[1:])
+        for token in tokens:
+            channels.update(self.terms.get(token, ()))
+            for words, phrase_channels in self.phrases.get(token, {}).items():
+                if words <= tokens:
+                    channels.update(phrase_channels)
+        if channels or self.routed:
+            return channels
+        return {self.default_channel}
+
+class TweetDeduper:
+    """Remembers what was relayed recently so repeats can be suppressed.
+
+    Each tweet is reduced to a few fingerprints: its own ID and that of any
+    quoted tweet, a hash of its text with links, punctuation and case
+    stripped, and the expanded URLs it links to. It is a repeat if any of them
+    was seen in the last ``window`` seconds. Entries are kept in insertion
+    order, so expiry and the ``size`` cap only ever touch the front."""
+
+    def __init__(self, window=900, size=5000):
+        self.window = window
+        self.size = size
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprints(data, text):
+        yield 'id', data['id_str']
+        quoted = data.get('quoted_status_id_str') or (data.get('quoted_status') or {}).get('id_str')
+        if quoted:
+            yield 'id', quoted
+        normalized = NON_WORD_RE.sub(' ', URL_RE.sub('', html.unescape(text)).lower()).strip()
+        if normalized:
+            yield 'text', hash(normalized)
+        entities = (data.get('extended_tweet') or data).get('entities') or {}
+        for url in entities.get('urls') or ():
+            if url.get('expanded_url'):
+                yield 'url', url['expanded_url']
+
+    @staticmethod
+    def _repeats(entry, fingerprint, author):
+        # the same account linking the same page again is usually news
+        # about it (a slip, a scrub), so links only count across accounts
+        return entry is not None and (fingerprint[0] != 'url' or entry[1] != author)
+
+    def admit(self, data, text, channels):
+        """Returns the ``channels`` that haven't seen this tweet within the window.
+
+        Fingerprints are kept per channel, so a tweet held back as a repeat
+        in one channel still reaches another that never saw it."""
+        if not self.window:
+            return list(channels)
+        author = data['user']['id_str']
+        prints = list(self.fingerprints(data, text))
+        now = time.monotonic()
+        admitted = []
+        with self._lock:
+            seen = self._seen
+            while seen and next(iter(seen.values()))[0] <= now:
+                seen.popitem(last=False)
+            for channel in channels:
+                if any(self._repeats(seen.get((channel, fingerprint)), fingerprint, author)
+                       for fingerprint in prints):
+                    continue
+                admitted.append(channel)
+                for fingerprint in prints:
+                    key = (channel, fingerprint)
+                    seen[key] = (now + self.window, author)
+                    seen.move_to_end(key)
+            while len(seen) > self.size:
+                seen.popitem(last=False)
+        return admitted
+
+    def __len__(self):
+        return len(self._seen)
+
+class OutboundQueue:
+    """Bounded buffer between the stream reader and IRC.
+
+    The stream thread only ever appends here, and a dedicated sender thread
+    takes the hit from Sopel's flood protection. When the queue is full the
+    oldest tweet is dropped, or with ``coalesce`` the new one is counted into a
+    "N more tweets" line sent once the queue drains.
+
+    Lines are held for ``burst`` seconds before sending, and anything from the
+    same account arriving meanwhile is appended to the waiting line as long
+    as it still fits on one IRC line."""
+
+    def __init__(self, bot, size, overflow='drop_oldest', burst=0):
+        self.bot = bot
+        # drop_oldest needs something to drop
+        self.size = max(1, size)
+        self.overflow = overflow
+        self.burst = burst
+        self.dropped = 0
+        self._items = collections.deque()
+        # (channel, key) -> its newest line still waiting to be sent
+        self._tails = {}
+        self._coalesced = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='twitter-sender', daemon=True)
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def put(self, channel, message, key=None, more=None, limit=IRC_LINE_BYTES):
+        """Queues ``message``, or appends ``more`` to the waiting line from ``key``."""
+        with self._cond:
+            tail = self._tails.get((channel, key)) if key else None
+            if tail is not None and more:
+                merged = f"{tail[1]} | {more}"
+                if len(merged.encode('utf-8')) <= limit:
+                    tail[1] = merged
+                    METRICS.incr('tweets_merged')
+                    return
+            if len(self._items) >= self.size:
+                self.dropped += 1
+                if self.overflow == 'coalesce':
+                    self._coalesced[channel] = self._coalesced.get(channel, 0) + 1
+                    return
+                self._forget(self._items.popleft())
+            item = [channel, message, key, time.monotonic() + self.burst]
+            self._items.append(item)
+            if key:
+                self._tails[(channel, key)] = item
+            self._cond.notify()
+
+    def _forget(self, item):
+        if self._tails.get((item[0], item[2])) is item:
+            del self._tails[(item[0], item[2])]
+
+    def _next(self):
+        with self._cond:
+            while not self._stopping:
+                timeout = None
+                if self._items:
+                    timeout = self._items[0][3] - time.monotonic()
+                    if timeout <= 0:
+                        item = self._items.popleft()
+                        self._forget(item)
+                        return item[0], item[1]
+                elif self._coalesced:
+                    channel, count = self._coalesced.popitem()
+                    return channel, "[{} more tweet{} not shown]".format(count, "" if count == 1 else "s")
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            channel, message = item
+            try:
+                with METRICS.timer('say'):
+                    self.bot.say(message, channel)
+                METRICS.incr('tweets_relayed', channel=channel)
+            except Exception:
+                METRICS.incr('relay_errors')
+                LOGGER.exception("Couldn't relay tweet")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+class MyStreamer:
+    """Our stream callbacks, mixed into twython's TwythonStreamer by _streamer_class()."""
+
+    # status code of the last HTTP error, None for network errors and stalls
+    last_status = None
 
     def on_success(self, data):
+        METRICS.incr('tweets_received')
+        with METRICS.timer('on_success'):
+            self._relay(data)
+
+    def _relay(self, data):
         try:
             if not data['in_reply_to_status_id'] and not data['in_reply_to_user_id_str']:
                 if not data['retweeted'] and 'RT @' not in data['text']:
@@ -62,49 +427,125 @@ class MyStreamer(TwythonStreamer):
                         else:
                             url = ''
 
-                    text = text.replace('\n', ' ')
-                    text = text.strip()
-                    text = html.unescape(text)               
+                    routed = ROUTES.channels(data['user']['id_str'], text)
+                    if not routed:
+                        METRICS.incr('tweets_unrouted')
+                        return
+                    channels = DEDUP.admit(data, text, routed)
+                    if len(channels) < len(routed):
+                        METRICS.incr('tweets_duplicate', len(routed) - len(channels))
+                    if not channels:
+                        return
 
-                    message = ('\x02{name} (@{screen_name})\x02 {text}').format(
-                                name=data['user']['name'],
-                                screen_name=data['user']['screen_name'],
-                                text=text)
-                    sopel_instance.say(message, sopel_instance.config.twittertwython.twitter_channel)
+                    limit = min(_irc_budget(channel) for channel in channels)
+                    message = _format_tweet(data['user']['name'], data['user']['screen_name'], text, limit)
+                    more = _clean_text(text)
+                    for channel in channels:
+                        QUEUE.put(channel, message, data['user']['id_str'], more, limit)
+                    METRICS.incr('tweets_queued')
         except:
             LOGGER.info(f"Unhandled Tweet: {data}")
 
-    def on_error(self, status_code, data):
+    def on_error(self, status_code, data, headers=None):
         LOGGER.error(f"Twitter ERROR: {status_code}")
-    
-@module.interval(100)
-@module.thread(True)
-def twitterThread(bot):
-    global api
-    global myStream
-    global myStreamListener
-    global sopel_instance
-    global firstStart
-    global LOGGER
+        # twython would reconnect straight away, leave that to the supervisor
+        self.last_status = status_code
+        self.disconnect()
+
+    def on_timeout(self):
+        LOGGER.error("Twitter stream timed out")
+        self.disconnect()
+
+@functools.lru_cache(maxsize=None)
+def _streamer_class():
+    # twython pulls in requests and oauthlib, so only import it once the stream starts
+    from twython import TwythonStreamer
+    return type('MyStreamer', (MyStreamer, TwythonStreamer), {})
+
+class StreamSupervisor(threading.Thread):
+    """Keeps the filter stream connected for the lifetime of the plugin.
+
+    Reconnects follow Twitter's guidelines: network errors and stalls back
+    off linearly, HTTP errors exponentially from 5 seconds and rate limiting
+    (420/429) exponentially from a minute, all with some jitter. Twitter sends
+    a keep-alive every 30 seconds, so a read timeout of ``stall_timeout``
+    means the connection has stalled."""
+
+    stall_timeout = 90
 
-    sopel_instance = bot
+    def __init__(self, bot):
+        super().__init__(name='twitter-stream', daemon=True)
+        self.bot = bot
+        self.stream = None
+        self.reconnects = 0
+        self._stopping = threading.Event()
 
-    if (firstStart):
-        LOGGER.info("Twitter Stream Started for channel {}".format(bot.config.twittertwython.twitter_channel))
-        firstStart = False
-        # Authenticate to Twitter
-        stream = MyStreamer(bot.config.twittertwython.consumer_key, bot.config.twittertwython.consumer_secret,
-                    bot.config.twittertwython.access_token, bot.config.twittertwython.token_secret)
-        
+    @staticmethod
+    def backoff(status, failures):
+        if status in (420, 429):
+            delay = min(60 * 2 ** failures, 960)
+        elif status:
+            delay = min(5 * 2 ** failures, 320)
+        else:
+            delay = min(0.25 * (failures + 1), 16)
+        return delay * random.uniform(1, 1.2)
+
+    def _connect(self):
+        section = self.bot.config.twittertwython
+        self.stream = _streamer_class()(section.consumer_key, section.consumer_secret,
+                                        section.access_token, section.token_secret,
+                                        timeout=self.stall_timeout)
+        LOGGER.info("Twitter Stream Started for {} users and {} terms".format(len(ROUTES.follow), len(ROUTES.track)))
         try:
-            if (bot.config.twittertwython.twitter_query):
-                stream.statuses.filter(follow=bot.config.twittertwython.twitter_follow, track=bot.config.twittertwython.twitter_query)
+            if (ROUTES.track):
+                self.stream.statuses.filter(follow=ROUTES.follow, track=ROUTES.track)
             else:
-                stream.statuses.filter(follow=bot.config.twittertwython.twitter_follow)
-        except:
-                stream.disconnect()
-                LOGGER.error("Twiter Stream Error. Restarting.")
-                firstStart = True
-
+                self.stream.statuses.filter(follow=ROUTES.follow)
+        except Exception as e:
+            if not self._stopping.is_set():
+                LOGGER.error(f"Twitter Stream Error: {e}")
+        finally:
+            self.stream.disconnect()
         LOGGER.info("Twitter Stream Stopped")
-        firstStart = True
\ No newline at end of file
+
+    def run(self):
+        failures = 0
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            self._connect()
+            if self._stopping.is_set():
+                break
+            # a connection that stayed up past the stall timeout was healthy
+            if time.monotonic() - started > self.stall_timeout:
+                failures = 0
+            delay = self.backoff(self.stream.last_status, failures)
+            failures += 1
+            self.reconnects += 1
+            METRICS.incr('stream_reconnects', status=self.stream.last_status or 'network')
+            LOGGER.info(f"Reconnecting to Twitter in {delay:.1f}s")
+            self._stopping.wait(delay)
+
+    def stop(self):
+        self._stopping.set()
+        if self.stream:
+            self.stream.disconnect()
+
+@module.commands('twitterqueue')
+@module.require_admin
+def twitter_queue(bot, trigger):
+    """Shows the tweet relay queue depth and how many tweets were dropped."""
+    bot.reply(f"Queued: {QUEUE.depth}/{QUEUE.size} Dropped: {QUEUE.dropped} Overflow: {QUEUE.overflow} "
+              f"Received: {METRICS.total('tweets_received')} Relayed: {METRICS.total('tweets_relayed')} "
+              f"Duplicates: {METRICS.total('tweets_duplicate')} Merged: {METRICS.total('tweets_merged')} "
+              f"Reconnects: {METRICS.total('stream_reconnects')}")
+    
+@module.event('001')
+@module.rule('.*')
+def start_stream(bot, trigger):
+    _start_supervisor(bot)
+
+def _start_supervisor(bot):
+    global SUPERVISOR
+    if SUPERVISOR is None or not SUPERVISOR.is_alive():
+        SUPERVISOR = StreamSupervisor(bot)
+        SUPERVISOR.start()